@@ -0,0 +1,89 @@
+"""
+import_time.py
+
+Import-time budget for stim_table.
+
+Runs `python -X importtime -c "import stim_table"` in fresh interpreters and
+checks that
+    - pandas, h5py and matplotlib are not imported, and
+    - the median cumulative import time of stim_table is within budget.
+
+Exits with status 1 if either check fails.
+
+Usage:
+    python benchmarks/import_time.py [--budget-ms 250] [--repeat 7]
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('pandas', 'h5py', 'matplotlib')
+
+
+def measure_import_us(module):
+    """
+    Returns the cumulative import time (us) of a module in a fresh
+        interpreter, and the names of all modules it imported.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=REPO_ROOT,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    cumulative_us = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            cumulative_us = int(cumulative)
+    return cumulative_us, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--budget-ms', type=float, default=250.0)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    # warm the bytecode cache so compilation is not measured
+    measure_import_us('stim_table')
+
+    times_us = []
+    for _ in range(args.repeat):
+        cumulative_us, imported = measure_import_us('stim_table')
+        times_us.append(cumulative_us)
+    median_ms = sorted(times_us)[len(times_us) // 2] / 1000.0
+    numpy_ms = measure_import_us('numpy')[0] / 1000.0
+
+    heavy = sorted(
+        name for name in imported if name.split('.')[0] in HEAVY_MODULES
+    )
+
+    print('import stim_table: %.1f ms median of %i (numpy alone: %.1f ms)'
+          % (median_ms, args.repeat, numpy_ms))
+    print('budget: %.1f ms' % args.budget_ms)
+
+    failed = False
+    if heavy:
+        print('FAIL: heavy modules imported: %s' % ', '.join(heavy))
+        failed = True
+    if median_ms > args.budget_ms:
+        print('FAIL: import time over budget')
+        failed = True
+    if not failed:
+        print('OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,363 @@
+"""
+regression_checks.py
+
+Regression checks of the vectorized stim_table code against the loops it
+replaced.
+
+Each check builds random synthetic inputs, runs the current stim_table
+function and a plain Python reimplementation of the old loop, and compares
+the results. No session data is needed.
+
+Exits with status 1 if any check fails.
+
+Usage:
+    python benchmarks/regression_checks.py [--seed 0] [--repeat 5]
+
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import stim_table  # noqa: E402
+
+
+def old_clean_photodiode_rises(photodiode_rise, ptd_start, ptd_end,
+                               min_interval):
+    """
+    Returns photodiode_rise and ptd_end after deleting the last short
+        interval's rise until none is left, as the old load_sync loop did.
+    """
+    ptd_rise_diff = np.ediff1d(photodiode_rise)
+    while any(ptd_rise_diff[ptd_start:ptd_end] < min_interval):
+        error_frames = (
+            np.where(ptd_rise_diff[ptd_start:ptd_end] < min_interval)[0]
+            + ptd_start
+        )
+        photodiode_rise = np.delete(photodiode_rise, error_frames[-1])
+        ptd_end -= 1
+        ptd_rise_diff = np.ediff1d(photodiode_rise)
+    return photodiode_rise, ptd_end
+
+
+def check_photodiode_rises(rng):
+    """
+    clean_photodiode_rises on rises every ~2 s with bursts of spurious rises.
+    """
+    num_rises = int(rng.integers(10, 500))
+    rises = np.cumsum(rng.uniform(1.9, 2.1, num_rises))
+    num_spurious = int(rng.integers(0, num_rises // 2))
+    spurious = (rng.choice(rises, num_spurious)
+                + rng.uniform(0.0, 1.9, num_spurious))
+    photodiode_rise = np.sort(np.concatenate((rises, spurious)))
+
+    ptd_start = int(rng.integers(0, 5))
+    ptd_end = len(photodiode_rise) - 1 - int(rng.integers(0, 5))
+
+    expected_rise, expected_end = old_clean_photodiode_rises(
+        photodiode_rise, ptd_start, ptd_end, 1.8
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        cleaned_rise, cleaned_end, report = stim_table.clean_photodiode_rises(
+            photodiode_rise, ptd_start, ptd_end, min_interval=1.8
+        )
+    assert np.array_equal(cleaned_rise, expected_rise), \
+        'kept rises differ from the old loop'
+    assert cleaned_end == expected_end, 'ptd_end differs from the old loop'
+    assert len(report) == len(photodiode_rise) - len(expected_rise), \
+        'report does not list every removed rise'
+
+
+def old_sweep_frames(sweep_frames, display_sequence):
+    """
+    Returns start and end of each sweep remapped onto display_sequence, one
+        segment at a time as the old get_sweep_frames loop did.
+    """
+    start = sweep_frames[:, 0] + display_sequence[0, 0]
+    dif = sweep_frames[:, 1] - sweep_frames[:, 0]
+    for seg in range(len(display_sequence) - 1):
+        for i in range(len(start)):
+            if start[i] >= display_sequence[seg, 1]:
+                start[i] = (start[i] - display_sequence[seg, 1]
+                            + display_sequence[seg + 1, 0])
+    end = start + dif
+    keep = (end <= display_sequence[-1, 1]) & (start <= display_sequence[-1, 1])
+    return start[keep], end[keep]
+
+
+def check_sweep_frames(rng):
+    """
+    get_sweep_frames and build_stim_table on a display sequence given in
+        fractional seconds.
+    """
+    fps = 30
+    pre_blank_sec = 2
+    num_segments = rng.integers(1, 20)
+    durations = rng.uniform(5.0, 60.0, num_segments)
+    gaps = rng.uniform(0.5, 30.0, num_segments)
+    seg_starts = np.cumsum(gaps) + np.concatenate(([0], np.cumsum(durations[:-1])))
+    display_sequence = np.column_stack((seg_starts, seg_starts + durations))
+
+    sweep_len = int(rng.integers(1, 60))
+    displayed_frames = int(durations.sum() * fps)
+    num_sweeps = displayed_frames // sweep_len + 5  # a few past the end
+    sweep_frames = [(i * sweep_len, (i + 1) * sweep_len - 1)
+                    for i in range(num_sweeps)]
+
+    data = {
+        'fps': float(fps),
+        'pre_blank_sec': float(pre_blank_sec),
+        'stimuli': [{
+            'stim_path': 'C:/fractional.stim',
+            'sweep_frames': sweep_frames,
+            'sweep_order': list(range(num_sweeps)),
+            'display_sequence': display_sequence.tolist(),
+        }],
+    }
+
+    # the old loop, on the display sequence in whole stimulus frames
+    frame_sequence = np.round(
+        (display_sequence + pre_blank_sec) * fps
+    ).astype(int)
+    start, end = old_sweep_frames(np.array(sweep_frames), frame_sequence)
+
+    timing_table = stim_table.get_sweep_frames(data, 0, verbose=False)
+    assert np.issubdtype(timing_table['start'].dtype, np.integer), \
+        'sweep starts are not integer frames'
+    assert np.array_equal(timing_table['start'].to_numpy(), start), \
+        'sweep starts differ from the old loop'
+    assert np.array_equal(timing_table['end'].to_numpy(), end), \
+        'sweep ends differ from the old loop'
+
+    twop_frames = np.arange(frame_sequence[-1, 1] + 1)[:, None] // 2
+    with contextlib.redirect_stdout(io.StringIO()):
+        table = stim_table.build_stim_table(
+            data, twop_frames,
+            {'stim_name': 'fractional', 'sweep_order': 'Frame'},
+        )
+    assert np.array_equal(table['Start'].to_numpy(), start // 2), \
+        'stim table starts differ from the old loop'
+
+
+def old_count_sweeps_per_condition(table, columns):
+    """
+    Returns {condition values: number of sweeps} for the conditions with any
+        sweeps, and the number of blank sweeps, by testing every combination
+        of column values as the old count_sweeps_per_condition loop did.
+    """
+    params = stim_table.get_params(table, columns)
+    counts = {}
+    for combination in range(stim_table.num_combinations(params)):
+        combination_params = stim_table.condition_combination_to_params(
+            params, combination
+        )
+        rows_in_condition = np.ones((len(table),), dtype=bool)
+        for column in columns:
+            rows_in_condition &= (
+                table[column].values == combination_params[column]
+            )
+        if rows_in_condition.any():
+            key = tuple(combination_params[column] for column in columns)
+            counts[key] = int(rows_in_condition.sum())
+    num_blank = int(np.sum(table[columns[0]].isnull().values))
+    return counts, num_blank
+
+
+def check_condition_counts(rng):
+    """
+    count_sweeps_per_condition on a random grating table with blank sweeps.
+    """
+    import pandas as pd
+
+    columns = ['SF', 'TF', 'Ori', 'Contrast']
+    num_sweeps = int(rng.integers(1, 2000))
+    table = pd.DataFrame({
+        'SF': rng.choice([0.02, 0.04, 0.08], num_sweeps),
+        'TF': rng.choice([1.0, 2.0, 4.0, 8.0], num_sweeps),
+        'Ori': rng.choice(np.arange(0.0, 360.0, 45.0), num_sweeps),
+        'Contrast': rng.choice([0.1, 0.8], num_sweeps),
+    })
+    blank = rng.random(num_sweeps) < 0.1
+    table.loc[blank, columns] = np.nan
+
+    expected, expected_blank = old_count_sweeps_per_condition(table, columns)
+    counts = stim_table.count_sweeps_per_condition(table, columns)
+    observed = {
+        tuple(row[column] for column in columns): int(row['num_sweeps'])
+        for _, row in counts.drop(index=-1).iterrows()
+    }
+    assert observed == expected, 'condition counts differ from the old loop'
+    assert int(counts.loc[-1, 'num_sweeps']) == expected_blank, \
+        'blank count differs from the old loop'
+
+
+def brute_force_response_stats(traces, table, condition_ids, num_conditions):
+    """
+    Returns count, mean and var (ddof=1) of the mean response of each cell
+        to each condition, from every trial's full window at once. Blank
+        sweeps are the last column.
+    """
+    num_frames = traces.shape[1]
+    starts = table['Start'].to_numpy(dtype=float, na_value=np.nan)
+    ends = table['End'].to_numpy(dtype=float, na_value=np.nan)
+    responses = [[] for _ in range(num_conditions + 1)]
+    for i_trial in range(len(table)):
+        if not (np.isfinite(starts[i_trial]) and np.isfinite(ends[i_trial])):
+            continue
+        first = min(max(int(starts[i_trial]), 0), num_frames)
+        last = min(int(ends[i_trial]), num_frames)
+        if last <= first:
+            continue
+        condition = condition_ids[i_trial]
+        condition = num_conditions if condition < 0 else condition
+        responses[condition].append(traces[:, first:last].mean(axis=1))
+
+    num_cells = traces.shape[0]
+    count = np.array([len(r) for r in responses])
+    mean = np.full((num_cells, num_conditions + 1), np.nan)
+    var = np.full((num_cells, num_conditions + 1), np.nan)
+    for condition, condition_responses in enumerate(responses):
+        if len(condition_responses) > 0:
+            mean[:, condition] = np.mean(condition_responses, axis=0)
+        if len(condition_responses) > 1:
+            var[:, condition] = np.var(condition_responses, axis=0, ddof=1)
+    return count, mean, var
+
+
+def check_response_stats(rng):
+    """
+    get_condition_response_stats with chunks shorter than the trials, on
+        overlapping trials, trials past the end of the traces and blank
+        sweeps.
+    """
+    import pandas as pd
+
+    num_cells = int(rng.integers(1, 20))
+    num_frames = int(rng.integers(100, 5000))
+    traces = rng.normal(10.0, 3.0, (num_cells, num_frames))
+
+    num_trials = int(rng.integers(1, 300))
+    starts = rng.integers(-10, num_frames + 10, num_trials)
+    ends = starts + rng.integers(1, 60, num_trials)
+    table = pd.DataFrame({
+        'Start': pd.array(starts, dtype='Int32'),
+        'End': pd.array(ends, dtype='Int32'),
+        'Ori': rng.choice(np.arange(0.0, 360.0, 45.0), num_trials),
+    })
+    table.loc[rng.random(num_trials) < 0.1, 'Ori'] = np.nan
+    table.loc[rng.random(num_trials) < 0.05, 'Start'] = pd.NA
+
+    condition_index = stim_table.ConditionIndex.from_table(table, ['Ori'])
+    num_conditions = len(condition_index)
+    count, mean, var = brute_force_response_stats(
+        traces, table, condition_index.condition_ids, num_conditions
+    )
+    stats = stim_table.get_condition_response_stats(
+        traces, table, condition_index=condition_index,
+        chunk_frames=int(rng.integers(1, 100)),
+    )
+    assert np.array_equal(stats['count'], count[:num_conditions]) \
+        and stats['blank_count'] == count[num_conditions], \
+        'trial counts differ from brute force'
+    assert np.allclose(stats['mean'], mean[:, :num_conditions], equal_nan=True) \
+        and np.allclose(stats['blank_mean'], mean[:, num_conditions], equal_nan=True), \
+        'means differ from brute force'
+    assert np.allclose(stats['var'], var[:, :num_conditions], equal_nan=True) \
+        and np.allclose(stats['blank_var'], var[:, num_conditions], equal_nan=True), \
+        'variances differ from brute force'
+
+
+def check_epoch_lookup(rng):
+    """
+    StimulusEpochIndex.lookup on overlapping and nested sweeps of several
+        stimuli, with imaging ending before the last sweeps.
+    """
+    num_stimuli = int(rng.integers(1, 6))
+    num_stim_frames = int(rng.integers(100, 3000))
+    stimuli = []
+    for _ in range(num_stimuli):
+        num_sweeps = int(rng.integers(0, 60))
+        sweep_starts = rng.integers(0, num_stim_frames, num_sweeps)
+        sweep_ends = sweep_starts + rng.integers(1, 300, num_sweeps)
+        stimuli.append({
+            'stim_path': 'C:/overlapping.stim',
+            'sweep_frames': np.column_stack((sweep_starts, sweep_ends)).tolist(),
+            'display_sequence': [[0, num_stim_frames + 300]],
+        })
+    data = {'fps': 1.0, 'pre_blank_sec': 0.0, 'stimuli': stimuli}
+
+    # two stimulus frames per 2P frame, imaging stops before the stimulus
+    twop_frames = np.arange(num_stim_frames + 301, dtype=float) // 2
+    twop_frames[int(rng.integers(0, len(twop_frames))):] = np.nan
+
+    # brute force: the latest started sweep that is on, ties to the later
+    # stimulus and row
+    starts, ends, sweep_ids = [], [], []
+    for i_stim in range(num_stimuli):
+        timing_table = stim_table.get_sweep_frames(data, i_stim, verbose=False)
+        for i_sweep in range(len(timing_table)):
+            start = twop_frames[timing_table['start'].iloc[i_sweep]]
+            end = twop_frames[timing_table['end'].iloc[i_sweep]]
+            if np.isfinite(start) and np.isfinite(end):
+                starts.append(start)
+                ends.append(end)
+                sweep_ids.append((i_stim, i_sweep))
+    starts = np.array(starts)
+    ends = np.array(ends)
+    frames = np.arange(-2, num_stim_frames // 2 + 160)
+    expected_stimulus = np.full(frames.shape, -1)
+    expected_sweep = np.full(frames.shape, -1)
+    for i_frame, frame in enumerate(frames):
+        is_on = np.flatnonzero((starts <= frame) & (frame < ends))
+        if len(is_on) > 0:
+            latest = max(is_on, key=lambda i: (starts[i], i))
+            expected_stimulus[i_frame], expected_sweep[i_frame] = sweep_ids[latest]
+
+    index = stim_table.StimulusEpochIndex(data, twop_frames)
+    stimulus, sweep = index.lookup(frames)
+    assert np.array_equal(stimulus, expected_stimulus), \
+        'stimulus on differs from brute force'
+    assert np.array_equal(sweep, expected_sweep), \
+        'sweep on differs from brute force'
+
+
+CHECKS = [
+    ('photodiode cleaning', check_photodiode_rises),
+    ('sweep frame remap', check_sweep_frames),
+    ('condition counts', check_condition_counts),
+    ('condition response stats', check_response_stats),
+    ('epoch lookup', check_epoch_lookup),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+
+    failed = False
+    for name, check in CHECKS:
+        try:
+            for _ in range(args.repeat):
+                check(rng)
+        except AssertionError as e:
+            print('FAIL: %s: %s' % (name, e))
+            failed = True
+        else:
+            print('%s: OK' % name)
+    if not failed:
+        print('OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
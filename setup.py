@@ -6,4 +6,6 @@ distutils.core.setup(
     author='Dan Millman',
     version='0.1',
     py_modules=['stim_table'],
-)
\ No newline at end of file
+    packages=['sync_py3', 'stim_table_data'],
+    package_data={'stim_table_data': ['clip_info_train.pkl', 'clip_info_test.pkl']},
+)
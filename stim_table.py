@@ -5,107 +5,133 @@ Created on Mon Apr 22 17:33:28 2019
 @author: danielm
 """
 import os, sys, warnings
+import base64, functools, io
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 
 from sync_py3 import Dataset
 
-package_path = '/Users/danielm/Desktop/py_code/StimTable/'
+package_path = os.path.dirname(os.path.abspath(__file__))
+
+# The *_tables entry points accept an experiment directory or a Session;
+# passing the same Session to several of them loads the stim pkl and sync
+# file only once.
 
 def three_session_A_tables(exptpath):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
-    
-    stim_table = {}
-    stim_table['drifting_gratings'] = drifting_gratings_table(data, twop_frames)
-    stim_table['natural_movie_1'] = natural_movie_1_table(data,twop_frames)
-    stim_table['natural_movie_3'] = natural_movie_3_table(data,twop_frames)
-    stim_table['spontaneous'] = get_spontaneous_table(data,twop_frames)
+    session = get_session(exptpath)
     
-    return stim_table
+    return session.tables(['drifting_gratings',
+                           'natural_movie_1',
+                           'natural_movie_3',
+                           'spontaneous'])
 
 def three_session_B_tables(exptpath):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
-    
-    stim_table = {}
-    stim_table['static_gratings'] = static_gratings_table(data, twop_frames)
-    stim_table['natural_images'] = natural_images_table(data,twop_frames)
-    stim_table['natural_movie_1'] = natural_movie_1_table(data,twop_frames)
-    stim_table['spontaneous'] = get_spontaneous_table(data,twop_frames)
+    session = get_session(exptpath)
     
-    return stim_table
+    return session.tables(['static_gratings',
+                           'natural_images',
+                           'natural_movie_1',
+                           'spontaneous'])
 
 def three_session_C_tables(exptpath):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
+    session = get_session(exptpath)
     
-    stim_table = {}
-    stim_table['locally_sparse_noise_4deg'] = locally_sparse_noise_4deg_table(data, twop_frames)
-    stim_table['locally_sparse_noise_8deg'] = locally_sparse_noise_8deg_table(data, twop_frames)
-    stim_table['natural_movie_1'] = natural_movie_1_table(data,twop_frames)
-    stim_table['natural_movie_2'] = natural_movie_2_table(data,twop_frames)
-    stim_table['spontaneous'] = get_spontaneous_table(data,twop_frames)
-    
-    return stim_table
+    return session.tables(['locally_sparse_noise_4deg',
+                           'locally_sparse_noise_8deg',
+                           'natural_movie_1',
+                           'natural_movie_2',
+                           'spontaneous'])
 
 def VisualBehavior_NM1_table(exptpath,session_ID,frames_per_rep=900,num_reps=10):
     
+    return VisualBehavior_movie_table(exptpath,session_ID,'fingerprint',
+                                      frames_per_rep=frames_per_rep,
+                                      num_reps=num_reps)
+
+def VisualBehavior_movie_table(exptpath,session_ID,movie_name='fingerprint',frames_per_rep=None,num_reps=None):
+    """Return the frame table of a movie item of a VisualBehavior session.
+    Inputs:
+        exptpath (str)
+            -- Path prefix of the session's _stim.pkl and _sync.h5 files.
+        session_ID
+        movie_name (str)
+            -- Key of the movie in data['items']['behavior']['items'].
+        frames_per_rep, num_reps (int)
+            -- See movie_frame_table; inferred from the pkl by default.
+    """
+    import pandas as pd
+    
     data = pd.read_pickle(exptpath+str(session_ID)+'_stim.pkl')
     twop_frames, stim_vsync_rise = load_sync_VB(exptpath+str(session_ID)+'_sync.h5')
 
-    #36000 stim frames (600 seconds?)
-    NM1_stim_frames = data['items']['behavior']['items']['fingerprint']['frame_indices']
-    frame_in_movie = data['items']['behavior']['items']['fingerprint']['static_stimulus']['frame_list']
+    movie = data['items']['behavior']['items'][movie_name]
+    
+    return movie_frame_table(movie['frame_indices'],
+                             movie['static_stimulus']['frame_list'],
+                             stim_vsync_rise,
+                             frames_per_rep=frames_per_rep,
+                             num_reps=num_reps)
+
+def movie_frame_table(frame_indices,frame_list,stim_vsync_rise,frames_per_rep=None,num_reps=None):
+    """Return a table (Start_Time, End_Time, Frame) with one row per movie
+    frame presentation.
+    A presentation starts wherever frame_list changes to a movie frame
+    (gray frames are negative), from the first presentation of frame 0 on.
+    It ends when the next presentation starts; the last one lasts the median
+    presentation duration.
+    Inputs:
+        frame_indices (array)
+            -- Stimulus frame of each entry of frame_list.
+        frame_list (array)
+            -- Movie frame shown at each entry.
+        stim_vsync_rise (array)
+            -- Time of each stimulus frame, from load_sync_VB.
+        frames_per_rep (int)
+            -- Movie frames per repeat; by default max(frame_list) + 1.
+        num_reps (int)
+            -- Repeats to include; by default all of them.
+    """
+    import pandas as pd
     
-    print(NM1_stim_frames)
-    print(len(stim_vsync_rise))
+    frame_list = np.asarray(frame_list)
+    stim_frames = np.minimum(np.asarray(frame_indices), len(stim_vsync_rise) - 1)
+    block_start_times = np.asarray(stim_vsync_rise)[stim_frames]
     
-    start_frames = NM1_stim_frames
-    start_frames[start_frames>=len(stim_vsync_rise)] = len(stim_vsync_rise) - 1
+    if not np.any(frame_list == 0):
+        raise ValueError('Movie frame 0 not found in frame_list')
+    first_frame = np.argmax(frame_list == 0)
     
-    whole_block_start_times = stim_vsync_rise[start_frames]
+    is_start = np.zeros(len(frame_list), dtype=bool)
+    is_start[first_frame] = True
+    is_start[first_frame+1:] = (np.diff(frame_list[first_frame:]) != 0) & (frame_list[first_frame+1:] >= 0)
+    starts = np.flatnonzero(is_start)
     
-    first_NM1_frame = np.argwhere(frame_in_movie==0)[0,0]
-    print('first frame: '+str(first_NM1_frame))
+    frames = frame_list[starts]
+    start_time = block_start_times[starts]
+    end_time = np.append(start_time[1:], np.nan)
+    rep = np.cumsum(frames == 0) - 1
     
-    start_time = np.zeros((num_reps*frames_per_rep,))
-    end_time = np.zeros((num_reps*frames_per_rep,))
-    NM1_frame_indices = np.zeros((num_reps*frames_per_rep,))
-    frame_start_idx = first_NM1_frame
-    for rep in range(num_reps):
-        for NM1_frame_number in range(frames_per_rep):
-            
-            row = int(rep*frames_per_rep + NM1_frame_number)
-            
-            start_time[row] = whole_block_start_times[frame_start_idx]
-            NM1_frame_indices[row] = NM1_frame_number
-            
-            next_frame_number = NM1_frame_number + 1
-            if NM1_frame_number==(frames_per_rep-1):
-                next_frame_number = 0
-            
-            #find range of stim frames during this NM1_frame presentation:
-            if rep==(num_reps-1) and next_frame_number==0:
-                median_frame_time = np.median(end_time - start_time)
-                end_time[row] = start_time[row] + median_frame_time
-            else:
-                next_frame_idx = frame_start_idx + np.argwhere(frame_in_movie[frame_start_idx:]==next_frame_number)[0,0]
-                end_time[row] = whole_block_start_times[next_frame_idx]
-                
-            frame_start_idx = next_frame_idx
+    if frames_per_rep is None:
+        frames_per_rep = int(frame_list.max()) + 1
+    if num_reps is None:
+        num_reps = int(rep[-1]) + 1
+    keep = (rep < num_reps) & (frames < frames_per_rep)
+    frames = frames[keep]
+    start_time = start_time[keep]
+    end_time = end_time[keep]
     
-    NM1_table = pd.DataFrame(np.column_stack((start_time,end_time,NM1_frame_indices)), columns=('Start_Time','End_Time','Frame'))
+    end_time[-1] = start_time[-1] + np.median(end_time[:-1] - start_time[:-1])
     
-    return NM1_table
+    return pd.DataFrame({'Start_Time': start_time,
+                         'End_Time': end_time,
+                         'Frame': frames.astype(np.int32)},
+                        columns=('Start_Time','End_Time','Frame'))
 
-def load_sync_VB(syncpath,verbose=False,LONG_STIM_THRESH=0.2):
+def load_sync_VB(syncpath,verbose=False,LONG_STIM_THRESH=0.2,sidecar=False,diagnostics=None):
     
-    d = Dataset(syncpath)
+    d = Dataset(syncpath, sidecar=sidecar)
     
     if verbose:
         print(d.line_labels)
@@ -118,27 +144,25 @@ def load_sync_VB(syncpath,verbose=False,LONG_STIM_THRESH=0.2):
     sample_freq = d.meta_data['ni_daq']['counter_output_freq']
 
     # get sync timing for each channel
-    twop_vsync_fall = d.get_falling_edges(vsync_2p_label) / sample_freq
+    edges = d.get_all_edges([vsync_2p_label, vsync_stim_label, photodiode_label])
+    twop_vsync_fall = edges[vsync_2p_label][1] / sample_freq
     stim_vsync_fall = (
-        d.get_falling_edges(vsync_stim_label)[1:] / sample_freq
+        edges[vsync_stim_label][1][1:] / sample_freq
     )  # eliminating the DAQ pulse
-    photodiode_rise = d.get_rising_edges(photodiode_label) / sample_freq
+    photodiode_rise = edges[photodiode_label][0] / sample_freq
 
     ptd_rise_diff = np.ediff1d(photodiode_rise)
     
-    stim_vsync_rise = d.get_rising_edges(vsync_stim_label) / sample_freq
+    stim_vsync_rise = edges[vsync_stim_label][0] / sample_freq
     if (stim_vsync_rise[1] - stim_vsync_rise[0]) > LONG_STIM_THRESH:
         stim_vsync_rise = stim_vsync_rise[1:]
     
-    if verbose:
-        plt.figure()
-        plt.plot(photodiode_rise,np.zeros((len(photodiode_rise),)),'o')
-        #plt.xlim(0,100)
-        plt.show()
-        
-        plt.figure()
-        plt.hist(ptd_rise_diff,range=[0,5])
-        plt.show()
+    qc = {
+        'sync_path': syncpath,
+        'photodiode_rise': photodiode_rise,
+        'ptd_rise_diff': ptd_rise_diff,
+        'ptd_errors': None,
+    }
 
     # make sure all of the sync data are available
     channels = {
@@ -175,8 +199,9 @@ def load_sync_VB(syncpath,verbose=False,LONG_STIM_THRESH=0.2):
             0
         ]
         ptd_start = 3
+        short = set(short)
         for i in medium:
-            if set(range(i - 2, i)) <= set(short):
+            if (i - 2) in short and (i - 1) in short:
                 ptd_start = i + 1
                 
         if photodiode_rise.max() <= stim_vsync_fall.max():
@@ -192,16 +217,10 @@ def load_sync_VB(syncpath,verbose=False,LONG_STIM_THRESH=0.2):
             print('ptd_start: ' + str(ptd_start))
             print("Photodiode events before stimulus start.  Deleted.")
     
-        ptd_errors = []
-        while any(ptd_rise_diff[ptd_start:ptd_end] < 1.8):
-            error_frames = (
-                np.where(ptd_rise_diff[ptd_start:ptd_end] < 1.8)[0] + ptd_start
-            )
-            print("Photodiode error detected. Number of frames:", len(error_frames))
-            photodiode_rise = np.delete(photodiode_rise, error_frames[-1])
-            ptd_errors.append(photodiode_rise[error_frames[-1]])
-            ptd_end -= 1
-            ptd_rise_diff = np.ediff1d(photodiode_rise)
+        photodiode_rise, ptd_end, ptd_errors = clean_photodiode_rises(
+            photodiode_rise, ptd_start, ptd_end
+        )
+        qc['ptd_errors'] = ptd_errors
     
         first_pulse = ptd_start
         stim_on_photodiode_idx = 60 + 120 * np.arange(0, ptd_end - ptd_start, 1)
@@ -221,83 +240,190 @@ def load_sync_VB(syncpath,verbose=False,LONG_STIM_THRESH=0.2):
     stim_time = stim_vsync_fall + delay
 
     # convert stimulus frames into twop frames
-    twop_frames = np.empty((len(stim_time), 1))
-    for i in range(len(stim_time)):
-        # crossings = np.nonzero(np.ediff1d(np.sign(twop_vsync_fall - stim_time[i]))>0)
-        crossings = (
-            np.searchsorted(twop_vsync_fall, stim_time[i], side='left') - 1
-        )
-        if crossings < (len(twop_vsync_fall) - 1):
-            twop_frames[i] = crossings
-        else:
-            twop_frames[i : len(stim_time)] = np.NaN
-            warnings.warn('Acquisition ends before stimulus.', RuntimeWarning)
-            break
+    twop_frames = align_times_to_frames(stim_time, twop_vsync_fall)[:, np.newaxis]
+
+    if diagnostics is not None:
+        qc['delay'] = delay
+        diagnostics(qc)
 
     return twop_frames, (stim_vsync_rise+delay)
 
 def omFish_gratings_tables(exptpath,verbose=False):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
+    session = get_session(exptpath)
 
-    stim_table = {}  
-    stim_table['drifting_gratings_contrast'] = drifting_gratings_table(data,twop_frames,stim_name='drifting_gratings_contrast')
-    stim_table['drifting_gratings_TF'] = drifting_gratings_table(data,twop_frames,stim_name='drifting_gratings_TF')
+    stim_table = session.tables(['drifting_gratings_contrast',
+                                 'drifting_gratings_TF'])
     
     if verbose:
-        count_sweeps_per_condition(stim_table['drifting_gratings_contrast'])
-        count_sweeps_per_condition(stim_table['drifting_gratings_TF'])
+        print(count_sweeps_per_condition(stim_table['drifting_gratings_contrast']))
+        print(count_sweeps_per_condition(stim_table['drifting_gratings_TF']))
     
     return stim_table
 
 def SparseNoise_tables(exptpath):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
-    
-    stim_table = {}
-    stim_table['sparse_noise'] = sparse_noise_table(data, twop_frames)
-    stim_table['spontaneous'] = get_spontaneous_table(data,twop_frames)
+    session = get_session(exptpath)
     
-    return stim_table
+    return session.tables(['sparse_noise',
+                           'spontaneous'])
 
 def SizeByContrast_tables(exptpath,verbose=False):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
+    session = get_session(exptpath)
 
-    print_all_stim_types(data)
+    print_all_stim_types(session.data)
 
-    stim_table = {}  
-    stim_table['size_by_contrast'] = drifting_gratings_table(data,twop_frames,stim_name='size_by_contrast')
-    stim_table['visual_behavior_flashes'] = visual_behavior_flashes_table(data,twop_frames)
+    stim_table = session.tables(['size_by_contrast',
+                                 'visual_behavior_flashes'])
     
     if verbose:
-        count_sweeps_per_condition(stim_table['size_by_contrast'],columns=['SF','TF','Ori','Contrast','Size'])
+        print(count_sweeps_per_condition(stim_table['size_by_contrast'],columns=['SF','TF','Ori','Contrast','Size']))
         print(stim_table['size_by_contrast'])
         print(stim_table['visual_behavior_flashes'])
     
     return stim_table
 
 def count_sweeps_per_condition(stim_table,columns=['SF','TF','Ori','Contrast']):
+    """Return the number of sweeps of each condition in stim_table.
+    Inputs:
+        stim_table (DataFrame)
+        columns (list of str)
+            -- Columns whose combined values define a condition.
+    Returns:
+        DataFrame with the values of columns and 'num_sweeps' for each
+        observed condition (index: condition id, in sorted order), and a
+        last row (index -1, null values) counting the blank sweeps, i.e. the
+        sweeps where any of columns is null.
+    """
+    import pandas as pd
+    
+    condition_ids, conditions = _factorize_conditions(stim_table, columns)
+    
+    counts = conditions.copy()
+    counts['num_sweeps'] = np.bincount(condition_ids[condition_ids >= 0], minlength=len(conditions))
+    blank = pd.DataFrame({'num_sweeps': [np.sum(condition_ids < 0)]}, index=[-1])
+    
+    return pd.concat([counts, blank])
 
-    num_sweeps = len(stim_table)    
-
-    params = get_params(stim_table,columns)
-        
-    for combination in range(num_combinations(params)):
-        
-        combination_params = condition_combination_to_params(params,combination)
+def _factorize_conditions(stim_table, columns):
+    """Return (condition_ids, conditions) for the sweeps of stim_table.
+    conditions is a DataFrame with one row per observed combination of the
+    values of columns, sorted by value. condition_ids holds the row of
+    conditions of each sweep, or -1 if any of its values is null (blank).
+    """
+    import pandas as pd
+    
+    codes = np.empty((len(stim_table), len(columns)), dtype=np.int64)
+    column_values = []
+    for i_col, column in enumerate(columns):
+        codes[:, i_col], values = pd.factorize(stim_table[column], sort=True)
+        column_values.append(np.asarray(values))
+    
+    is_blank = np.any(codes < 0, axis=1)
+    condition_codes, inverse = np.unique(codes[~is_blank], axis=0, return_inverse=True)
+    condition_ids = np.full((len(stim_table),), -1, dtype=np.int64)
+    condition_ids[~is_blank] = np.ravel(inverse)
+    
+    conditions = pd.DataFrame(
+        {column: column_values[i_col][condition_codes[:, i_col]] for i_col, column in enumerate(columns)},
+        columns=columns,
+    )
+    return condition_ids, conditions
+
+class ConditionIndex(object):
+    """Rows of each condition of a stim table, in CSR form.
+    The rows of condition k are rows[offsets[k]:offsets[k+1]], in table
+    order, so selecting all trials of a condition is a slice.
+    Example:
+        index = ConditionIndex.from_table(stim_table, ['TF', 'Ori'])
+        index.conditions.loc[k]     # TF and Ori of condition k
+        stim_table.iloc[index.trials(k)]
+    Attributes:
+        condition_ids (array)
+            -- Condition of each row of the table; -1 for blank sweeps.
+        conditions (DataFrame)
+            -- Values of the condition columns, one row per condition.
+        offsets (array)
+            -- Start of each condition in rows; len(conditions) + 1 long.
+        rows (array)
+            -- Table rows grouped by condition.
+        blank_rows (array)
+            -- Rows of the blank sweeps.
+    """
+    
+    def __init__(self, condition_ids, conditions):
+        self.condition_ids = np.asarray(condition_ids, dtype=np.int64)
+        self.conditions = conditions
         
-        print(combination_params)
+        # a stable sort keeps the rows of each condition in table order
+        order = np.argsort(self.condition_ids, kind='stable')
+        num_blank = np.sum(self.condition_ids < 0)
+        self.blank_rows = order[:num_blank]
+        self.rows = order[num_blank:]
+        counts = np.bincount(self.condition_ids[self.rows], minlength=len(conditions))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+    
+    @classmethod
+    def from_table(cls, stim_table, columns=None):
+        """Index the conditions of stim_table.
+        Inputs:
+            stim_table (DataFrame)
+            columns (list of str)
+                -- Columns whose combined values define a condition; by
+                   default all columns except Start, End and condition.
+        """
+        if columns is None:
+            columns = [column for column in stim_table.columns
+                       if column not in ('Start', 'End', 'condition')]
+        return cls(*_factorize_conditions(stim_table, columns))
+    
+    def __len__(self):
+        return len(self.conditions)
+    
+    def trials(self, condition):
+        """Return the table rows of condition (int)."""
+        return self.rows[self.offsets[condition]:self.offsets[condition+1]]
+    
+    def num_trials(self):
+        """Return the number of rows of each condition."""
+        return np.diff(self.offsets)
+    
+    def save(self, path):
+        """Save the index to an .npz file."""
+        columns = list(self.conditions.columns)
+        arrays = {}
+        for i_col, column in enumerate(columns):
+            values = self.conditions[column].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)  # no pickled objects in the file
+            arrays['condition_{}'.format(i_col)] = values
+        np.savez(path,
+                 condition_ids=self.condition_ids,
+                 columns=np.array(columns, dtype=str),
+                 **arrays)
+    
+    @classmethod
+    def load(cls, path):
+        """Load an index saved by save."""
+        import pandas as pd
         
-        rows_in_condition = np.ones((num_sweeps,),dtype=np.bool)
-        for i_col,column in enumerate(columns):
-            rows_in_condition = rows_in_condition & (stim_table[column].values==combination_params[column])
-            
-        print(sum(rows_in_condition))
-    print('Num blank sweeps: '+str(np.sum(stim_table['Ori'].isnull().values)))
+        with np.load(path, allow_pickle=False) as f:
+            columns = [str(column) for column in f['columns']]
+            conditions = pd.DataFrame(
+                {column: f['condition_{}'.format(i_col)] for i_col, column in enumerate(columns)},
+                columns=columns,
+            )
+            return cls(f['condition_ids'], conditions)
+
+def add_condition_index(stim_table, columns=None):
+    """Add an integer 'condition' column (-1 for blank sweeps) to stim_table.
+    Returns:
+        (stim_table, ConditionIndex)
+    """
+    condition_index = ConditionIndex.from_table(stim_table, columns)
+    stim_table['condition'] = condition_index.condition_ids.astype(np.int32)
+    return stim_table, condition_index
 
 def get_params(stim_table,columns):
     params = {}
@@ -337,83 +463,132 @@ def condition_combination_to_params(params,combination):
 
 def coarse_mapping_create_stim_tables(exptpath):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
+    session = get_session(exptpath)
     
-    stim_table = {}
-    stim_table['locally_sparse_noise'] = locally_sparse_noise_table(data,twop_frames)
-    stim_table['drifting_gratings_grid'] = DGgrid_table(data,twop_frames)
-
-    return stim_table
+    return session.tables(['locally_sparse_noise',
+                           'drifting_gratings_grid'])
     
 def lsnCS_create_stim_tables(exptpath):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
-    
-    stim_table = {}
-    stim_table['center_surround'] = center_surround_table(data,twop_frames)
-    stim_table['locally_sparse_noise'] = locally_sparse_noise_table(data,twop_frames)
+    session = get_session(exptpath)
     
-    return stim_table
+    return session.tables(['center_surround',
+                           'locally_sparse_noise'])
 
 def MovieClips_tables(exptpath,num_train_segments=5,num_test_segments=10,verbose=False):
     
-    data = load_stim(exptpath)
-    twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise = load_sync(exptpath)
-    train_info = pd.read_pickle(package_path+'clip_info_train.pkl')
-    test_info = pd.read_pickle(package_path+'clip_info_test.pkl')
+    session = get_session(exptpath)
     
-    stim_table = {}
+    segment_names = []
     for train_segment in range(num_train_segments):
-        segment_name = 'clips_train_' + str(1+train_segment)
-        stim_table[segment_name] = MovieClips_one_segment_table(data,twop_frames,segment_name,train_info)
-        
+        segment_names.append('clips_train_' + str(1+train_segment))
     for test_segment in range(num_test_segments):
-        segment_name = 'clips_test_' + str(1+test_segment) 
-        stim_table[segment_name] = MovieClips_one_segment_table(data,twop_frames,segment_name,test_info)
+        segment_names.append('clips_test_' + str(1+test_segment))
+    
+    stim_table = session.tables(segment_names)
     
     if verbose:
         print(stim_table)
     
     return stim_table
 
-def MovieClips_one_segment_table(data,twop_frames,segment_name,info_df):
+# clip info pickles are package data, installed with the module
+clip_info_path = os.path.join(package_path, 'stim_table_data')
+
+def load_clip_info(segment_name):
+    """Return the clip info DataFrame (train or test) for a clips segment."""
+    if segment_name.startswith('clips_train'):
+        return _read_clip_info('clip_info_train.pkl')
+    return _read_clip_info('clip_info_test.pkl')
+
+@functools.lru_cache(maxsize=None)
+def _read_clip_info(filename):
+    import pandas as pd
     
-    segment_idx = get_stimulus_index(data,segment_name)
+    return pd.read_pickle(os.path.join(clip_info_path, filename))
+
+@functools.lru_cache(maxsize=None)
+def get_clip_end_frames():
+    """Return a dict of stim_name -> end frames of its clips, from the train
+    and test clip info (see load_clip_info). Loaded once per process.
+    """
+    clip_end_frames = {}
+    for segment_kind in ('clips_train', 'clips_test'):
+        info_df = load_clip_info(segment_kind)
+        for stim_name, end_frames in info_df.groupby('stim_name', sort=False)['end_frame']:
+            clip_end_frames[stim_name] = end_frames.to_numpy()
+    return clip_end_frames
+
+def get_clip_frame_labels(clip_end_frames, num_frames):
+    """Return the clip number and frame within the clip of each frame of a
+    segment. Frames from the end of the last clip on are -1.
+    Inputs:
+        clip_end_frames (array)
+            -- Increasing segment frame at which each clip ends.
+        num_frames (int)
+    Returns:
+        (clip_number, frame_in_clip) int32 arrays of length num_frames.
+    """
+    clip_end_frames = np.asarray(clip_end_frames, dtype=int)
+    num_clips = len(clip_end_frames)
+    clip_start_frames = np.concatenate(([0], clip_end_frames))
+    
+    frames = np.arange(num_frames)
+    clip_number = np.searchsorted(clip_end_frames, frames, side='right')
+    in_clip = clip_number < num_clips
+    frame_in_clip = frames - clip_start_frames[np.minimum(clip_number, num_clips)]
+    
+    clip_number = np.where(in_clip, clip_number, -1).astype(np.int32)
+    frame_in_clip = np.where(in_clip, frame_in_clip, -1).astype(np.int32)
+    return clip_number, frame_in_clip
+
+def MovieClips_one_segment_table(data,twop_frames,segment_name,info_df=None,segment_idx=None):
+    
+    if segment_idx is None:
+        segment_idx = get_stimulus_index(data,segment_name)
     stim_name = get_stim_name_for_segment(segment_name)
 
-    is_stim = np.argwhere((info_df['stim_name'] == stim_name).values)[:,0]
-    #clip_start_frames = info_df['start_frame'].values[is_stim]
-    clip_end_frames = info_df['end_frame'].values[is_stim]
-    num_clips = len(is_stim)
+    if info_df is None:
+        clip_end_frames = get_clip_end_frames().get(stim_name, [])
+    else:
+        clip_end_frames = info_df['end_frame'].values[(info_df['stim_name'] == stim_name).values]
+    if len(clip_end_frames) == 0:
+        raise KeyError('No clip info for {} ({})'.format(segment_name, stim_name))
     
     timing_table = get_sweep_frames(data,segment_idx)
-    num_segment_frames = len(timing_table)
 
     stim_table = init_table(twop_frames,timing_table)
     stim_table['stim_name'] = stim_name
 
-    clip_number = -1 * np.ones((num_segment_frames,))
-    frame_in_clip = -1 * np.ones((num_segment_frames,))
-    curr_clip = 0
-    curr_frame = 0
-    for nf in range(num_segment_frames):
-        if nf == clip_end_frames[curr_clip]:
-            curr_clip += 1
-            curr_frame = 0
-            if curr_clip==num_clips:
-                break
-            
-        clip_number[nf] = curr_clip
-        frame_in_clip[nf] = curr_frame
-        curr_frame += 1
-            
+    clip_number, frame_in_clip = get_clip_frame_labels(clip_end_frames, len(timing_table))
     stim_table['clip_number'] = clip_number
     stim_table['frame_in_clip'] = frame_in_clip
 
     return stim_table
 
+def MovieClips_segment_tables(data,twop_frames,segment_names):
+    """Build the tables of several clips segments with one walk over
+    data['stimuli']. Each segment is the first stimulus whose stim_path
+    contains its name, as in get_stimulus_index.
+    Returns:
+        dict of segment name -> stim table.
+    """
+    segment_indices = {}
+    for i_stim, stim_data in enumerate(data['stimuli']):
+        for segment_name in segment_names:
+            if segment_name not in segment_indices and segment_name in stim_data['stim_path']:
+                segment_indices[segment_name] = i_stim
+    
+    stim_tables = {}
+    for segment_name in segment_names:
+        if segment_name not in segment_indices:
+            raise KeyError('Stimulus with stim_name={} not found!'.format(segment_name))
+        stim_tables[segment_name] = MovieClips_one_segment_table(
+            data, twop_frames, segment_name,
+            segment_idx=segment_indices[segment_name]
+        )
+    return stim_tables
+
 def get_stim_name_for_segment(segment_name):
     
     names = {'clips_train_1': 'PEsacc640_001_train',
@@ -435,212 +610,267 @@ def get_stim_name_for_segment(segment_name):
     
     return names[segment_name]
 
-def visual_behavior_flashes_table(data,twop_frames):
-    
-    stim_idx = get_stimulus_index(data,'visual_behavior_flashes')
-
-    print_all_stim_attributes(data, stim_idx)
-    
-    timing_table = get_sweep_frames(data,stim_idx)
-    
-    stim_table = init_table(twop_frames,timing_table)
-    stim_table['Image'] = data['stimuli'][stim_idx]['sweep_order'][:len(stim_table)]
-    
+# Declarative specs for tables built from a single stimulus. Each table has
+# Start/End columns from the sweep timing plus:
+#   'sweep_order': name of a column holding the sweep_order value per sweep
+#   'attributes': list of dimnames to look up per sweep from sweep_table, or
+#                 'dimnames' for all of the stimulus' dimnames
+# 'stim_name' is matched as a substring of each stimulus' stim_path.
+STIM_TABLE_SPECS = {
+    'drifting_gratings': {'stim_name': 'drifting_grating', 'attributes': 'dimnames'},
+    'drifting_gratings_contrast': {'stim_name': 'drifting_gratings_contrast', 'attributes': 'dimnames'},
+    'drifting_gratings_TF': {'stim_name': 'drifting_gratings_TF', 'attributes': 'dimnames'},
+    'size_by_contrast': {'stim_name': 'size_by_contrast', 'attributes': 'dimnames'},
+    'drifting_gratings_grid': {'stim_name': 'grating', 'attributes': ['TF', 'SF', 'Contrast', 'Ori', 'PosX', 'PosY']},
+    'static_gratings': {'stim_name': 'static_grating', 'attributes': ['SF', 'Contrast', 'Ori', 'Phase']},
+    'natural_images': {'stim_name': 'natural_images', 'sweep_order': 'Image'},
+    'visual_behavior_flashes': {'stim_name': 'visual_behavior_flashes', 'sweep_order': 'Image'},
+    'natural_movie_1': {'stim_name': 'natural_movie_1', 'sweep_order': 'Frame'},
+    'natural_movie_2': {'stim_name': 'natural_movie_2', 'sweep_order': 'Frame'},
+    'natural_movie_3': {'stim_name': 'natural_movie_3', 'sweep_order': 'Frame'},
+    'locally_sparse_noise': {'stim_name': 'locally_sparse_noise', 'sweep_order': 'Frame'},
+    'locally_sparse_noise_4deg': {'stim_name': 'locally_sparse_noise_4deg', 'sweep_order': 'Frame'},
+    'locally_sparse_noise_8deg': {'stim_name': 'locally_sparse_noise_8deg', 'sweep_order': 'Frame'},
+    'sparse_noise': {'stim_name': 'sparse_noise', 'sweep_order': 'Frame'},
+}
+
+def build_stim_table(data, twop_frames, spec, stimulus_idx=None, condition_index=False):
+    """Build the stim table described by spec (see STIM_TABLE_SPECS).
+    Inputs:
+        data (dict-like)
+        twop_frames (array)
+            -- 2P frame of each stimulus frame, from load_sync.
+        spec (dict)
+        stimulus_idx (int)
+            -- Stimulus to use; by default the first whose stim_path
+               contains spec['stim_name'].
+        condition_index (bool)
+            -- Also return the table's ConditionIndex, and add its
+               'condition' column (see add_condition_index).
+    """
+    if stimulus_idx is None:
+        stimulus_idx = get_stimulus_index(data, spec['stim_name'])
+    stimulus = data['stimuli'][stimulus_idx]
+    
+    timing_table = get_sweep_frames(data, stimulus_idx)
+    
+    stim_table = init_table(twop_frames, timing_table)
+    
+    if 'sweep_order' in spec:
+        sweep_order = np.array(stimulus['sweep_order'][:len(stim_table)])
+        if np.issubdtype(sweep_order.dtype, np.integer):
+            sweep_order = sweep_order.astype(np.int32)
+        stim_table[spec['sweep_order']] = sweep_order
+    
+    if 'attributes' in spec:
+        stim_attributes = spec['attributes']
+        if stim_attributes == 'dimnames':
+            stim_attributes = stimulus['dimnames']
+        attributes_by_sweep = get_attributes_by_sweep(data, stimulus_idx, stim_attributes)
+        for i_attribute, stim_attribute in enumerate(stim_attributes):
+            stim_table[stim_attribute] = attributes_by_sweep[:len(stim_table), i_attribute]
+    
+    if condition_index:
+        return add_condition_index(stim_table)
     return stim_table
 
-def drifting_gratings_table(data,twop_frames,stim_name='drifting_grating'):
+def build_stim_tables(data, twop_frames, names=None):
+    """Build several spec-driven stim tables with one walk over data['stimuli'].
+    Inputs:
+        data (dict-like)
+        twop_frames (array)
+        names (list of str)
+            -- Keys of STIM_TABLE_SPECS. Each is built from the first
+               stimulus whose stim_path contains its stim_name, as in the
+               individual *_table functions. Raises a KeyError if one is not
+               found. By default, every stimulus that matches a spec gets a
+               table, using the spec with the longest matching stim_name.
+    Returns:
+        dict of table name -> stim table.
+    """
+    candidates = list(STIM_TABLE_SPECS) if names is None else list(names)
     
-    DG_idx = get_stimulus_index(data,stim_name)
+    stimulus_for_table = {}
+    for i_stim, stim_data in enumerate(data['stimuli']):
+        matching = [name for name in candidates
+                    if STIM_TABLE_SPECS[name]['stim_name'] in stim_data['stim_path']]
+        if names is None and len(matching) > 0:
+            longest = max(len(STIM_TABLE_SPECS[name]['stim_name']) for name in matching)
+            matching = [name for name in matching
+                        if len(STIM_TABLE_SPECS[name]['stim_name']) == longest]
+        for name in matching:
+            stimulus_for_table.setdefault(name, i_stim)
+    
+    if names is not None:
+        for name in names:
+            if name not in stimulus_for_table:
+                raise KeyError('Stimulus with stim_name={} not found!'.format(
+                    STIM_TABLE_SPECS[name]['stim_name']))
+    else:
+        names = sorted(stimulus_for_table, key=stimulus_for_table.get)
     
-    timing_table = get_sweep_frames(data,DG_idx)
+    stim_tables = {}
+    for name in names:
+        stim_tables[name] = build_stim_table(data, twop_frames,
+                                             STIM_TABLE_SPECS[name],
+                                             stimulus_for_table[name])
+    return stim_tables
 
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_attributes = data['stimuli'][DG_idx]['dimnames']
-                       #  ['TF',
-                       # 'SF',
-                       # 'Contrast',
-                       # 'Ori'
-                       # ]
-    
-    for stim_attribute in stim_attributes:
-        stim_table[stim_attribute] = get_attribute_by_sweep(data, DG_idx, stim_attribute)[:len(stim_table)]
+def visual_behavior_flashes_table(data,twop_frames):
     
-    return stim_table
+    stim_idx = get_stimulus_index(data,'visual_behavior_flashes')
 
-def static_gratings_table(data,twop_frames):
-    
-    SG_idx = get_stimulus_index(data,'static_grating')
+    print_all_stim_attributes(data, stim_idx)
     
-    timing_table = get_sweep_frames(data,SG_idx)
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['visual_behavior_flashes'], stim_idx)
 
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_attributes = ['SF',
-                       'Contrast',
-                       'Ori',
-                       'Phase'
-                       ]
-    
-    for stim_attribute in stim_attributes:
-        stim_table[stim_attribute] = get_attribute_by_sweep(data, SG_idx, stim_attribute)[:len(stim_table)]
+def drifting_gratings_table(data,twop_frames,stim_name='drifting_grating',condition_index=False):
     
-    return stim_table
+    return build_stim_table(data, twop_frames, {'stim_name': stim_name, 'attributes': 'dimnames'},
+                            condition_index=condition_index)
 
-def natural_images_table(data,twop_frames):
-    
-    ns_idx = get_stimulus_index(data,'natural_images')
+def static_gratings_table(data,twop_frames,condition_index=False):
     
-    timing_table = get_sweep_frames(data,ns_idx)
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['static_gratings'],
+                            condition_index=condition_index)
 
-    stim_table = init_table(twop_frames,timing_table)
+def natural_images_table(data,twop_frames,condition_index=False):
     
-    stim_table['Image'] = np.array(data['stimuli'][ns_idx]['sweep_order'][:len(stim_table)])
-
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['natural_images'],
+                            condition_index=condition_index)
 
 def natural_movie_1_table(data,twop_frames):
     
-    nm_idx = get_stimulus_index(data,'natural_movie_1')
-    
-    timing_table = get_sweep_frames(data,nm_idx)
-
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_table['Frame'] = np.array(data['stimuli'][nm_idx]['sweep_order'][:len(stim_table)])
-
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['natural_movie_1'])
 
 def natural_movie_2_table(data,twop_frames):
     
-    nm_idx = get_stimulus_index(data,'natural_movie_2')
-    
-    timing_table = get_sweep_frames(data,nm_idx)
-
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_table['Frame'] = np.array(data['stimuli'][nm_idx]['sweep_order'][:len(stim_table)])
-
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['natural_movie_2'])
 
 def natural_movie_3_table(data,twop_frames):
     
-    nm_idx = get_stimulus_index(data,'natural_movie_3')
-    
-    timing_table = get_sweep_frames(data,nm_idx)
-
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_table['Frame'] = np.array(data['stimuli'][nm_idx]['sweep_order'][:len(stim_table)])
-
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['natural_movie_3'])
 
 def locally_sparse_noise_4deg_table(data,twop_frames):
     
-    lsn_idx = get_stimulus_index(data,'locally_sparse_noise_4deg')
-    
-    timing_table = get_sweep_frames(data,lsn_idx)
-
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_table['Frame'] = np.array(data['stimuli'][lsn_idx]['sweep_order'][:len(stim_table)])
-
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['locally_sparse_noise_4deg'])
 
 def locally_sparse_noise_8deg_table(data,twop_frames):
     
-    lsn_idx = get_stimulus_index(data,'locally_sparse_noise_8deg')
-    
-    timing_table = get_sweep_frames(data,lsn_idx)
-
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_table['Frame'] = np.array(data['stimuli'][lsn_idx]['sweep_order'][:len(stim_table)])
-
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['locally_sparse_noise_8deg'])
 
 def sparse_noise_table(data,twop_frames):
     
-    lsn_idx = get_stimulus_index(data,'sparse_noise')
-    
-    timing_table = get_sweep_frames(data,lsn_idx)
-
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_table['Frame'] = np.array(data['stimuli'][lsn_idx]['sweep_order'][:len(stim_table)])
-
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['sparse_noise'])
 
 def locally_sparse_noise_table(data,twop_frames):
     
-    lsn_idx = get_stimulus_index(data,'locally_sparse_noise')
-    
-    timing_table = get_sweep_frames(data,lsn_idx)
-
-    stim_table = init_table(twop_frames,timing_table)
-    
-    stim_table['Frame'] = np.array(data['stimuli'][lsn_idx]['sweep_order'][:len(stim_table)])
-
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['locally_sparse_noise'])
 
 def get_spontaneous_table(data,twop_frames):
     
-    MAX_SWEEPS = 50000
-    MIN_DURATION = 2000
-    start_frames = np.zeros((MAX_SWEEPS,))
-    end_frames = np.zeros((MAX_SWEEPS,))
+    return StimulusEpochIndex(data,twop_frames).spontaneous_table()
+
+class StimulusEpochIndex(object):
+    """Interval index of the sweeps of all stimuli of a session, in 2P frames.
+    A sweep is on from its start frame up to, not including, its end frame.
+    Sweeps that end after imaging (NaN frames) are left out.
+    Example:
+        index = StimulusEpochIndex(data, twop_frames)
+        stimulus, sweep = index.lookup(np.arange(num_imaging_frames))
+    Attributes:
+        starts, ends (array)
+            -- Start and end frame of every sweep, sorted by start.
+        stimulus, sweep (array)
+            -- Stimulus index and row of its timing table of every sweep.
+        max_ends (array)
+            -- Running maximum of ends, i.e. the frame until which some
+               sweep starting at or before each sweep is on.
+        breakpoints (array)
+            -- Sorted unique starts and ends. Between consecutive
+               breakpoints the same sweeps are on.
+        interval_sweeps (array)
+            -- Sweep (position in starts) on from each breakpoint to the
+               next, the latest started if several are; -1 if none.
+    """
     
-    curr_sweep = 0
-    for i_stim, stim_data in enumerate(data['stimuli']):
-        timing_table = get_sweep_frames(data,i_stim,verbose=False)
-        stim_sweeps = len(timing_table)
+    def __init__(self, data, twop_frames):
+        import heapq
         
-        start_frames[curr_sweep:(curr_sweep+stim_sweeps)] = twop_frames[timing_table['start'],0]
-        end_frames[curr_sweep:(curr_sweep+stim_sweeps)] = twop_frames[timing_table['end'],0]
-        curr_sweep += stim_sweeps
+        twop_frames = np.ravel(twop_frames)
+        starts = []
+        ends = []
+        stimulus = []
+        sweep = []
+        for i_stim, stim_data in enumerate(data['stimuli']):
+            timing_table = get_sweep_frames(data,i_stim,verbose=False)
+            starts.append(twop_frames[timing_table['start'].to_numpy()])
+            ends.append(twop_frames[timing_table['end'].to_numpy()])
+            stimulus.append(np.full((len(timing_table),), i_stim))
+            sweep.append(np.arange(len(timing_table)))
+        starts = np.concatenate(starts) if starts else np.zeros((0,))
+        ends = np.concatenate(ends) if ends else np.zeros((0,))
+        stimulus = np.concatenate(stimulus) if stimulus else np.zeros((0,), dtype=int)
+        sweep = np.concatenate(sweep) if sweep else np.zeros((0,), dtype=int)
         
-    start_frames = start_frames[:curr_sweep]
-    end_frames = end_frames[:curr_sweep]
-    
-    sort_idx = np.argsort(start_frames)
-    start_frames = start_frames[sort_idx]
-    end_frames = end_frames[sort_idx]
-    
-    intersweep_frames = start_frames[1:] - end_frames[:-1]
-    spontaneous_blocks = np.argwhere(intersweep_frames>MIN_DURATION)[:,0]
-    
-    sp_start_frames = []
-    sp_end_frames = []
-    for sp_idx in spontaneous_blocks:
-        sp_start_frames.append(end_frames[sp_idx])
-        sp_end_frames.append(start_frames[sp_idx+1])
+        in_imaging = np.isfinite(starts) & np.isfinite(ends)
+        order = np.argsort(starts[in_imaging], kind='stable')
+        self.starts = starts[in_imaging][order]
+        self.ends = ends[in_imaging][order]
+        self.stimulus = stimulus[in_imaging][order]
+        self.sweep = sweep[in_imaging][order]
+        self.max_ends = np.maximum.accumulate(self.ends) if len(self.ends) > 0 else self.ends
         
-    sp_table = pd.DataFrame(np.column_stack((sp_start_frames,sp_end_frames)), columns=('Start', 'End'))
-
-    return sp_table
-
-def DGgrid_table(data,twop_frames):
-    
-    DG_idx = get_stimulus_index(data,'grating')
-    
-    timing_table = get_sweep_frames(data,DG_idx)
+        # Resolve each elementary interval once, walking the breakpoints with
+        # a max-heap of the sweeps started so far. Sweeps that have ended
+        # are dropped when they reach the top of the heap.
+        self.breakpoints = np.unique(np.concatenate((self.starts, self.ends)))
+        self.interval_sweeps = np.full((len(self.breakpoints),), -1, dtype=np.int64)
+        started = []
+        next_sweep = 0
+        for k, frame in enumerate(self.breakpoints):
+            while next_sweep < len(self.starts) and self.starts[next_sweep] <= frame:
+                heapq.heappush(started, -next_sweep)
+                next_sweep += 1
+            while len(started) > 0 and self.ends[-started[0]] <= frame:
+                heapq.heappop(started)
+            if len(started) > 0:
+                self.interval_sweeps[k] = -started[0]
+    
+    def lookup(self, frames):
+        """Return the stimulus and sweep on at each of frames (array).
+        Where sweeps overlap, the one that started last is returned.
+        Returns:
+            (stimulus, sweep) int arrays, -1 where no sweep is on.
+        """
+        frames = np.asarray(frames)
+        if len(self.starts) == 0:
+            return np.full(frames.shape, -1), np.full(frames.shape, -1)
+        interval = np.searchsorted(self.breakpoints, frames, side='right') - 1
+        candidate = np.where(interval >= 0, self.interval_sweeps[np.maximum(interval, 0)], -1)
+        is_on = candidate >= 0
+        candidate = np.maximum(candidate, 0)
+        return (np.where(is_on, self.stimulus[candidate], -1),
+                np.where(is_on, self.sweep[candidate], -1))
+    
+    def spontaneous_table(self, min_duration=2000):
+        """Return a table (Start, End) of the gaps of more than min_duration
+        2P frames between sweeps."""
+        import pandas as pd
+        
+        gaps = self.starts[1:] - self.max_ends[:-1]
+        spontaneous_blocks = np.flatnonzero(gaps > min_duration)
+        
+        return pd.DataFrame({'Start': pd.array(self.max_ends[spontaneous_blocks], dtype='Int32'),
+                             'End': pd.array(self.starts[spontaneous_blocks+1], dtype='Int32')},
+                            columns=('Start', 'End'))
 
-    stim_table = init_table(twop_frames,timing_table)
+def DGgrid_table(data,twop_frames,condition_index=False):
     
-    stim_attributes = ['TF',
-                       'SF',
-                       'Contrast',
-                       'Ori',
-                       'PosX',
-                       'PosY'
-                       ]
-    
-    for stim_attribute in stim_attributes:
-        stim_table[stim_attribute] = get_attribute_by_sweep(data, DG_idx, stim_attribute)[:len(stim_table)]
-    
-    return stim_table
+    return build_stim_table(data, twop_frames, STIM_TABLE_SPECS['drifting_gratings_grid'],
+                            condition_index=condition_index)
 
-def center_surround_table(data,twop_frames):
+def center_surround_table(data,twop_frames,condition_index=False):
     
     center_idx = get_stimulus_index(data,'center')
     surround_idx = get_stimulus_index(data,'surround')
@@ -649,16 +879,27 @@ def center_surround_table(data,twop_frames):
 
     stim_table = init_table(twop_frames,timing_table)
 
-    stim_table['TF'] = get_attribute_by_sweep(data,center_idx,'TF')[:len(stim_table)]
-    stim_table['SF'] = get_attribute_by_sweep(data,center_idx,'SF')[:len(stim_table)]
-    stim_table['Contrast'] = get_attribute_by_sweep(data,center_idx,'Contrast')[:len(stim_table)]
-    stim_table['Center_Ori'] = get_attribute_by_sweep(data,center_idx,'Ori')[:len(stim_table)]
+    center_attributes = get_attributes_by_sweep(data,center_idx,['TF','SF','Contrast','Ori'])[:len(stim_table)]
+    stim_table['TF'] = center_attributes[:,0]
+    stim_table['SF'] = center_attributes[:,1]
+    stim_table['Contrast'] = center_attributes[:,2]
+    stim_table['Center_Ori'] = center_attributes[:,3]
     stim_table['Surround_Ori'] = get_attribute_by_sweep(data,surround_idx,'Ori')[:len(stim_table)]
 
+    if condition_index:
+        return add_condition_index(stim_table)
     return stim_table
 
 def init_table(twop_frames,timing_table):
-    return pd.DataFrame(np.column_stack((twop_frames[timing_table['start']],twop_frames[timing_table['end']])), columns=('Start', 'End'))
+    """Return a table with the 2P frames at the start and end of each sweep.
+    Frames are nullable Int32, <NA> for sweeps after the end of imaging.
+    """
+    import pandas as pd
+    twop_frames = np.ravel(twop_frames)
+    return pd.DataFrame({
+        'Start': pd.array(twop_frames[timing_table['start'].to_numpy()], dtype='Int32'),
+        'End': pd.array(twop_frames[timing_table['end'].to_numpy()], dtype='Int32'),
+    }, columns=('Start', 'End'))
 
 def get_stimulus_index(data, stim_name):
     """Return the index of stimulus in data.
@@ -671,8 +912,13 @@ def get_stimulus_index(data, stim_name):
     Returns:
         Index of stimulus stim_name in data.
     """
+    if isinstance(data, StimulusData) and stim_name in data.stimulus_indices:
+        return data.stimulus_indices[stim_name]
+
     for i_stim, stim_data in enumerate(data['stimuli']):
         if stim_name in stim_data['stim_path']:
+            if isinstance(data, StimulusData):
+                data.stimulus_indices[stim_name] = i_stim
             return i_stim
 
     raise KeyError('Stimulus with stim_name={} not found!'.format(stim_name))
@@ -680,34 +926,55 @@ def get_stimulus_index(data, stim_name):
 def get_display_sequence(data, stimulus_idx):
 
     display_sequence = np.array(
-        data['stimuli'][stimulus_idx]['display_sequence']
+        data['stimuli'][stimulus_idx]['display_sequence'], dtype=np.float64
     )
     pre_blank_sec = int(data['pre_blank_sec'])
     display_sequence += pre_blank_sec
     display_sequence *= int(data['fps'])  # in stimulus frames
 
-    return display_sequence
+    # display sequences given in fractional seconds start and end on whole
+    # stimulus frames
+    return np.round(display_sequence).astype(int)
     
 def get_sweep_frames(data, stimulus_idx, verbose = True):
+    """Return the timing table (start, end, dif in stimulus frames) of the
+    sweeps of a stimulus. Tables are computed once per StimulusData and
+    shared between callers, so they must not be modified in place.
+    """
+    if isinstance(data, StimulusData):
+        if stimulus_idx not in data.timing_tables:
+            data.timing_tables[stimulus_idx] = _get_sweep_frames(
+                data, stimulus_idx, verbose
+            )
+        return data.timing_tables[stimulus_idx]
+    return _get_sweep_frames(data, stimulus_idx, verbose)
 
-    sweep_frames = data['stimuli'][stimulus_idx]['sweep_frames']
-    timing_table = pd.DataFrame(
-        np.array(sweep_frames).astype(np.int), columns=('start', 'end')
-    )
-    timing_table['dif'] = timing_table['end'] - timing_table['start']
+def _get_sweep_frames(data, stimulus_idx, verbose):
+
+    import pandas as pd
+
+    sweep_frames = np.array(
+        data['stimuli'][stimulus_idx]['sweep_frames']
+    ).astype(int).reshape(-1, 2)
+    start = sweep_frames[:, 0]
+    dif = sweep_frames[:, 1] - sweep_frames[:, 0]
 
     display_sequence = get_display_sequence(data, stimulus_idx)
 
-    timing_table.start += display_sequence[0, 0]
-    for seg in range(len(display_sequence) - 1):
-        for index, row in timing_table.iterrows():
-            if row.start >= display_sequence[seg, 1]:
-                timing_table.start[index] = (
-                    timing_table.start[index]
-                    - display_sequence[seg, 1]
-                    + display_sequence[seg + 1, 0]
-                )
-    timing_table.end = timing_table.start + timing_table.dif
+    # Sweep frames count stimulus frames while the stimulus is displayed.
+    # A sweep that starts after the end of display segment k is shifted by
+    # the gaps between segments 0..k+1, i.e. by the gaps before the segment
+    # whose cumulative displayed duration contains it.
+    start = start + display_sequence[0, 0]
+    gaps = display_sequence[1:, 0] - display_sequence[:-1, 1]
+    offsets = np.concatenate(([0], np.cumsum(gaps)))
+    segment_ends = display_sequence[:-1, 1] - offsets[:-1]
+    start = start + offsets[np.searchsorted(segment_ends, start, side='right')]
+
+    timing_table = pd.DataFrame(
+        {'start': start, 'end': start + dif, 'dif': dif},
+        columns=('start', 'end', 'dif'),
+    )
     expected_sweeps = len(timing_table)
     timing_table = timing_table[timing_table.end <= display_sequence[-1, 1]]
     timing_table = timing_table[timing_table.start <= display_sequence[-1, 1]]
@@ -719,29 +986,54 @@ def get_sweep_frames(data, stimulus_idx, verbose = True):
 
     return timing_table
 
-def get_attribute_by_sweep(data, stimulus_idx, attribute):
-
-    attribute_idx = get_attribute_idx(data, stimulus_idx, attribute)
-
-    sweep_order = data['stimuli'][stimulus_idx]['sweep_order']
+def get_attribute_lookup(data, stimulus_idx, attributes):
+    """Return a (conditions + 1) x attributes array of attribute values.
+    Row i holds the values of condition i from sweep_table. The last row is
+    NaN, so that indexing with a sweep_order of -1 (blank sweep) gives NaN.
+    For 'Size' attributes the first element of the stored value is used.
+    sweep_table may also be a conditions x dimnames numeric array, as read
+    from the stim cache.
+    Inputs:
+        data (dict-like)
+        stimulus_idx (int)
+        attributes (list of str)
+            -- Names from the stimulus' dimnames.
+    """
+    attribute_idx = [
+        get_attribute_idx(data, stimulus_idx, attribute)
+        for attribute in attributes
+    ]
     sweep_table = data['stimuli'][stimulus_idx]['sweep_table']
 
-    num_sweeps = len(sweep_order)
+    lookup = np.full((len(sweep_table) + 1, len(attributes)), np.nan)
+    if isinstance(sweep_table, np.ndarray) and sweep_table.ndim == 2:
+        # numeric sweep_table from the stim cache, Size already reduced
+        lookup[:-1] = sweep_table[:, attribute_idx]
+        return lookup
+    for i_attribute, attribute in enumerate(attributes):
+        values = [condition[attribute_idx[i_attribute]] for condition in sweep_table]
+        if attribute.find('Size')!=-1:
+            values = [value[0] for value in values]
+        lookup[:-1, i_attribute] = values
+
+    return lookup
+
+def get_attributes_by_sweep(data, stimulus_idx, attributes):
+    """Return a sweeps x attributes array of attribute values.
+    All attribute columns are filled with one gather from the lookup array
+    of get_attribute_lookup. Blank sweeps (sweep_order -1) are NaN.
+    """
+    lookup = get_attribute_lookup(data, stimulus_idx, attributes)
 
-    attribute_by_sweep = np.zeros((num_sweeps,))
-    attribute_by_sweep[:] = np.NaN
+    sweep_order = np.asarray(data['stimuli'][stimulus_idx]['sweep_order'], dtype=int)
+    blank_row = len(lookup) - 1
+    sweep_order = np.where(sweep_order > -1, sweep_order, blank_row)
 
-    unique_conditions = np.unique(sweep_order)
-    for i_condition, condition in enumerate(unique_conditions):
-        sweeps_with_condition = np.argwhere(sweep_order == condition)[:, 0]
+    return lookup[sweep_order]
 
-        if condition > -1:  # blank sweep is -1
-            if attribute.find('Size')!=-1:
-                attribute_by_sweep[sweeps_with_condition] = sweep_table[condition][attribute_idx][0]
-            else:
-                attribute_by_sweep[sweeps_with_condition] = sweep_table[condition][attribute_idx]
+def get_attribute_by_sweep(data, stimulus_idx, attribute):
 
-    return attribute_by_sweep
+    return get_attributes_by_sweep(data, stimulus_idx, [attribute])[:, 0]
     
 def get_center_coordinates(data):
     
@@ -785,16 +1077,22 @@ def print_all_stim_types(data):
     for ns in range(num_stim):
         print(data['stimuli'][ns]['stim_path'])
     
-def load_stim(exptpath, verbose=True):
+def load_stim(exptpath, verbose=True, cache=False):
     """Load stim.pkl file into a DataFrame.
     Inputs:
         exptpath (str)
             -- Directory in which to search for files with _stim.pkl suffix.
         verbose (bool)
             -- Print filename (if found).
+        cache (bool)
+            -- Read the stimulus arrays from the columnar cache next to the
+               pkl (see write_stim_cache) instead of unpickling it, writing
+               the cache first if it is missing or out of date.
     Returns:
-        DataFrame with contents of stim pkl.
+        StimulusData (dict) with contents of stim pkl.
     """
+    import pandas as pd
+
     # Look for a file with the suffix '_stim.pkl'
     pklpath = None
     for f in os.listdir(exptpath):
@@ -810,9 +1108,220 @@ def load_stim(exptpath, verbose=True):
             )
         )
 
-    return pd.read_pickle(pklpath)
+    if cache:
+        data = read_stim_cache(pklpath)
+        if data is not None:
+            return data
+
+    data = StimulusData(pd.read_pickle(pklpath))
     
-def load_sync(exptpath, verbose=True):
+    if cache:
+        try:
+            write_stim_cache(pklpath, data)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            warnings.warn('Could not write stim cache for {}: {}'.format(pklpath, e), RuntimeWarning)
+
+    return data
+
+class StimulusData(dict):
+    """Contents of a stim.pkl for one session.
+    Behaves like the unpickled dict, and memoizes the timing table of each
+    stimulus and the index of each stimulus name, so that all table builders
+    of a session share one timing pass per stimulus.
+    """
+    
+    def __init__(self, data):
+        dict.__init__(self, data)
+        self.timing_tables = {}
+        self.stimulus_indices = {}
+
+# Columnar cache of a stim.pkl: a directory <pkl stem>_cache/ holding one .npy
+# file per stimulus array, and meta.json with the scalar fields and the size
+# and mtime of the pkl it was extracted from.
+stim_cache_version = 1
+STIM_CACHE_ARRAYS = ('sweep_frames', 'sweep_order', 'sweep_table', 'display_sequence')
+STIM_CACHE_FIELDS = ('stim_path', 'dimnames', 'stim')
+
+def get_stim_cache_path(pklpath):
+    return os.path.splitext(pklpath)[0] + '_cache'
+
+def _get_stim_cache_source(pklpath):
+    stat = os.stat(pklpath)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def _stim_cache_array(stim_data, key):
+    """Return stimulus field key as a numeric or string array, or None if it
+    cannot be stored without pickling. The sweep_table is stored as a
+    conditions x dimnames float array, with the first element of 'Size'
+    attributes as in get_attribute_lookup.
+    """
+    value = stim_data[key]
+    if key == 'sweep_table':
+        columns = []
+        for i_attribute, attribute in enumerate(stim_data['dimnames']):
+            values = [condition[i_attribute] for condition in value]
+            if attribute.find('Size')!=-1:
+                values = [v[0] if np.ndim(v) > 0 else v for v in values]
+            columns.append(values)
+        try:
+            return np.array(columns, dtype=float).T.reshape(len(value), len(columns))
+        except (TypeError, ValueError):
+            return None
+    try:
+        value = np.asarray(value)
+    except ValueError:
+        return None
+    if value.dtype == object:
+        return None
+    return value
+
+def write_stim_cache(pklpath, data):
+    """Write the columnar cache of the stim pkl at pklpath.
+    Fields that cannot be stored as plain arrays or JSON are left out of the
+    cache, and are read from the pkl on first access.
+    Inputs:
+        pklpath (str)
+        data (dict)
+            -- Unpickled contents of pklpath.
+    """
+    import json
+    import shutil
+    
+    cache_path = get_stim_cache_path(pklpath)
+    temp_path = cache_path + '.tmp{}'.format(os.getpid())
+    if os.path.isdir(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    
+    try:
+        meta = {
+            'version': stim_cache_version,
+            'source': _get_stim_cache_source(pklpath),
+            'fps': float(data['fps']),
+            'pre_blank_sec': float(data['pre_blank_sec']),
+            'stimuli': [],
+        }
+        for i_stim, stim_data in enumerate(data['stimuli']):
+            stim_meta = {'arrays': [], 'none': []}
+            for key in STIM_CACHE_FIELDS:
+                if key == 'dimnames' and key in stim_data:
+                    stim_meta[key] = [str(name) for name in stim_data[key]]
+                elif key in stim_data and stim_data[key] is not None:
+                    stim_meta[key] = str(stim_data[key])
+            for key in STIM_CACHE_ARRAYS:
+                if key not in stim_data:
+                    continue
+                if stim_data[key] is None:
+                    stim_meta['none'].append(key)
+                    continue
+                value = _stim_cache_array(stim_data, key)
+                if value is not None:
+                    np.save(os.path.join(temp_path, '{}_{}.npy'.format(i_stim, key)),
+                            value, allow_pickle=False)
+                    stim_meta['arrays'].append(key)
+            meta['stimuli'].append(stim_meta)
+    
+        # meta.json is written last: a cache without it is never read
+        with open(os.path.join(temp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(cache_path):
+            shutil.rmtree(cache_path)
+        os.rename(temp_path, cache_path)
+    except Exception:
+        # leave no partial cache behind, so the next load starts clean
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+def read_stim_cache(pklpath):
+    """Return a CachedStimulusData for the stim pkl at pklpath, or None if
+    there is no cache or it is out of date."""
+    import json
+    
+    meta_path = os.path.join(get_stim_cache_path(pklpath), 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except ValueError:
+        return None
+    if meta.get('version') != stim_cache_version:
+        return None
+    if meta.get('source') != _get_stim_cache_source(pklpath):
+        return None
+    return CachedStimulusData(pklpath, meta)
+
+class CachedStimulusData(StimulusData):
+    """StimulusData backed by the columnar cache of a stim pkl.
+    Stimulus arrays are memory-mapped from the cache on first access. Any
+    other key (e.g. 'items') unpickles the pkl once, on first access.
+    """
+    
+    def __init__(self, pklpath, meta):
+        self.pklpath = pklpath
+        self._pickled = None
+        cache_path = get_stim_cache_path(pklpath)
+        stimuli = [CachedStimulus(self, cache_path, i_stim, stim_meta)
+                   for i_stim, stim_meta in enumerate(meta['stimuli'])]
+        StimulusData.__init__(self, {
+            'fps': meta['fps'],
+            'pre_blank_sec': meta['pre_blank_sec'],
+            'stimuli': stimuli,
+        })
+    
+    def load_pickle(self):
+        """Return the unpickled stim pkl, loading it on first use."""
+        import pandas as pd
+        
+        if self._pickled is None:
+            self._pickled = pd.read_pickle(self.pklpath)
+        return self._pickled
+    
+    def __missing__(self, key):
+        value = self.load_pickle()[key]
+        self[key] = value
+        return value
+
+class CachedStimulus(dict):
+    """One stimulus of a CachedStimulusData."""
+    
+    def __init__(self, parent, cache_path, stimulus_idx, meta):
+        dict.__init__(self, {key: meta[key] for key in STIM_CACHE_FIELDS if key in meta})
+        for key in meta['none']:
+            self[key] = None
+        self._parent = parent
+        self._cache_path = cache_path
+        self._stimulus_idx = stimulus_idx
+        self._arrays = meta['arrays']
+    
+    def __missing__(self, key):
+        if key in self._arrays:
+            value = np.load(
+                os.path.join(self._cache_path, '{}_{}.npy'.format(self._stimulus_idx, key)),
+                mmap_mode='r',
+            )
+        else:
+            value = self._parent.load_pickle()['stimuli'][self._stimulus_idx][key]
+        self[key] = value
+        return value
+    
+def load_sync(exptpath, verbose=True, sidecar=False, diagnostics=None):
+    """Load the sync file in exptpath and align stimulus frames to 2P frames.
+    Inputs:
+        exptpath (str)
+            -- Directory in which to search for a file with _sync.h5 suffix.
+        verbose (bool)
+            -- Print progress and sync line information.
+        sidecar (bool)
+            -- Reuse or write a per-line edge index next to the sync file.
+        diagnostics (callable)
+            -- Optional hook called with a dict of QC arrays (photodiode
+               rises and intervals, removed photodiode errors, monitor
+               delay). See show_sync_diagnostics, save_sync_diagnostics and
+               BackgroundDiagnostics. Nothing is plotted by default.
+    Returns:
+        twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise
+    """
 
     # verify that sync file exists in exptpath
     syncpath = None
@@ -829,7 +1338,8 @@ def load_sync(exptpath, verbose=True):
         )    
 
     # load the sync data from .h5 and .pkl files
-    d = Dataset(syncpath)
+    # (sidecar: reuse/write a per-line edge index next to the sync file)
+    d = Dataset(syncpath, sidecar=sidecar)
     if verbose:
         print(d.line_labels)
     vsync_2p_label = get_2p_vsync_line_label(d)
@@ -840,22 +1350,20 @@ def load_sync(exptpath, verbose=True):
     sample_freq = d.meta_data['ni_daq']['counter_output_freq']
 
     # get sync timing for each channel
-    twop_vsync_fall = d.get_falling_edges(vsync_2p_label) / sample_freq
+    edges = d.get_all_edges([vsync_2p_label, vsync_stim_label, photodiode_label])
+    twop_vsync_fall = edges[vsync_2p_label][1] / sample_freq
     stim_vsync_fall = (
-        d.get_falling_edges(vsync_stim_label)[1:] / sample_freq
+        edges[vsync_stim_label][1][1:] / sample_freq
     )  # eliminating the DAQ pulse
-    photodiode_rise = d.get_rising_edges(photodiode_label) / sample_freq
+    photodiode_rise = edges[photodiode_label][0] / sample_freq
 
     ptd_rise_diff = np.ediff1d(photodiode_rise)
     
-    plt.figure()
-    plt.plot(photodiode_rise,np.zeros((len(photodiode_rise),)),'o')
-    #plt.xlim(0,100)
-    plt.show()
-    
-    plt.figure()
-    plt.hist(ptd_rise_diff,range=[0,5])
-    plt.show()
+    qc = {
+        'sync_path': syncpath,
+        'photodiode_rise': photodiode_rise,
+        'ptd_rise_diff': ptd_rise_diff,
+    }
 
     # make sure all of the sync data are available
     channels = {
@@ -889,8 +1397,9 @@ def load_sync(exptpath, verbose=True):
         0
     ]
     ptd_start = 3
+    short = set(short)
     for i in medium:
-        if set(range(i - 2, i)) <= set(short):
+        if (i - 2) in short and (i - 1) in short:
             ptd_start = i + 1
             
     if photodiode_rise.max() <= stim_vsync_fall.max():
@@ -906,16 +1415,10 @@ def load_sync(exptpath, verbose=True):
         print('ptd_start: ' + str(ptd_start))
         print("Photodiode events before stimulus start.  Deleted.")
 
-    ptd_errors = []
-    while any(ptd_rise_diff[ptd_start:ptd_end] < 1.8):
-        error_frames = (
-            np.where(ptd_rise_diff[ptd_start:ptd_end] < 1.8)[0] + ptd_start
-        )
-        print("Photodiode error detected. Number of frames:", len(error_frames))
-        photodiode_rise = np.delete(photodiode_rise, error_frames[-1])
-        ptd_errors.append(photodiode_rise[error_frames[-1]])
-        ptd_end -= 1
-        ptd_rise_diff = np.ediff1d(photodiode_rise)
+    photodiode_rise, ptd_end, ptd_errors = clean_photodiode_rises(
+        photodiode_rise, ptd_start, ptd_end
+    )
+    qc['ptd_errors'] = ptd_errors
 
     first_pulse = ptd_start
     stim_on_photodiode_idx = 60 + 120 * np.arange(0, ptd_end - ptd_start, 1)
@@ -934,72 +1437,903 @@ def load_sync(exptpath, verbose=True):
     stim_time = stim_vsync_fall + delay
 
     # convert stimulus frames into twop frames
-    twop_frames = np.empty((len(stim_time), 1))
-    for i in range(len(stim_time)):
-        # crossings = np.nonzero(np.ediff1d(np.sign(twop_vsync_fall - stim_time[i]))>0)
-        crossings = (
-            np.searchsorted(twop_vsync_fall, stim_time[i], side='left') - 1
+    twop_frames = align_times_to_frames(stim_time, twop_vsync_fall)[:, np.newaxis]
+
+    if diagnostics is not None:
+        qc['delay'] = delay
+        diagnostics(qc)
+
+    return twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise
+
+def plot_sync_diagnostics(qc, fig):
+    """Draw the photodiode QC plots of a load_sync diagnostics dict on fig."""
+    photodiode_rise = qc['photodiode_rise']
+    
+    ax = fig.add_subplot(2, 1, 1)
+    ax.plot(photodiode_rise, np.zeros((len(photodiode_rise),)), 'o')
+    ax.set_xlabel('Photodiode rise (s)')
+    
+    ax = fig.add_subplot(2, 1, 2)
+    ax.hist(qc['ptd_rise_diff'], range=[0, 5])
+    ax.set_xlabel('Interval between photodiode rises (s)')
+    
+    title = os.path.basename(qc['sync_path'])
+    if qc.get('delay') is not None:
+        title += '  monitor delay: {:.4f} s'.format(qc['delay'])
+    if qc.get('ptd_errors') is not None:
+        title += '  photodiode errors: {}'.format(len(qc['ptd_errors']))
+    fig.suptitle(title)
+
+def show_sync_diagnostics(qc):
+    """Diagnostics hook that shows the QC plots in interactive windows."""
+    import matplotlib.pyplot as plt
+    
+    fig = plt.figure()
+    plot_sync_diagnostics(qc, fig)
+    plt.show()
+
+def save_sync_diagnostics(qc, outpath):
+    """Render the QC plots to a .png or .html file without a display.
+    Uses the Agg canvas directly, so it can run outside the main thread.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    fig = Figure(figsize=(8, 6))
+    FigureCanvasAgg(fig)
+    plot_sync_diagnostics(qc, fig)
+    
+    if outpath.endswith('.html'):
+        png = io.BytesIO()
+        fig.savefig(png, format='png')
+        errors = qc.get('ptd_errors')
+        with open(outpath, 'w') as f:
+            f.write('<html><body>\n')
+            f.write('<img src="data:image/png;base64,{}"/>\n'.format(
+                base64.b64encode(png.getvalue()).decode('ascii')
+            ))
+            if errors is not None and len(errors) > 0:
+                f.write(errors.to_html(index=False))
+            f.write('\n</body></html>\n')
+    else:
+        fig.savefig(outpath)
+
+class BackgroundDiagnostics(object):
+    """Diagnostics hook that renders QC plots to files in a worker thread.
+    Each call queues the rendering and returns immediately; output goes to
+    output_dir as <sync file name>_qc.<fmt>. Call wait() to block until all
+    queued files are written.
+    """
+    
+    def __init__(self, output_dir, fmt='png'):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+    
+    def __call__(self, qc):
+        name = os.path.splitext(os.path.basename(qc['sync_path']))[0]
+        outpath = os.path.join(self.output_dir, name + '_qc.' + self.fmt)
+        self._pending.append(
+            self._executor.submit(save_sync_diagnostics, qc, outpath)
         )
-        if crossings < (len(twop_vsync_fall) - 1):
-            twop_frames[i] = crossings
+    
+    def wait(self):
+        """Block until queued diagnostics are written; re-raise failures."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+def clean_photodiode_rises(photodiode_rise, ptd_start, ptd_end, min_interval=1.8):
+    """Remove spurious photodiode rises in a single pass.
+    Within the window of rise intervals [ptd_start, ptd_end), a rise that is
+    followed by the next kept rise after less than min_interval is dropped.
+    Rises are swept from the end of the window backwards, which removes the
+    same rises as repeatedly deleting the last short interval.
+    Inputs:
+        photodiode_rise (array)
+            -- Photodiode rise times (sec).
+        ptd_start, ptd_end (int)
+            -- First and end (exclusive) indices of the intervals to check.
+        min_interval (float)
+            -- Shortest valid interval between photodiode rises (sec).
+    Returns:
+        photodiode_rise with the spurious rises removed, ptd_end adjusted for
+        the removals, and a DataFrame reporting the index and time of each
+        removed rise, the interval that caused its removal and the reason.
+    """
+    import pandas as pd
+
+    photodiode_rise = np.asarray(photodiode_rise)
+    rise_times = photodiode_rise.tolist()
+
+    keep = np.ones((len(rise_times),), dtype=bool)
+    removed = []
+    next_kept = ptd_end
+    for i in range(ptd_end - 1, ptd_start - 1, -1):
+        interval = rise_times[next_kept] - rise_times[i]
+        if interval < min_interval:
+            keep[i] = False
+            removed.append((i, rise_times[i], interval))
         else:
-            twop_frames[i : len(stim_time)] = np.NaN
+            next_kept = i
+
+    report = pd.DataFrame(removed[::-1], columns=('index', 'time', 'interval'))
+    report['reason'] = 'interval to next rise < {} s'.format(min_interval)
+
+    if len(removed) > 0:
+        print("Photodiode errors detected. Number of frames:", len(removed))
+
+    return photodiode_rise[keep], ptd_end - len(removed), report
+
+def align_times_to_frames(event_times, frame_times, mode='preceding'):
+    """Map event times onto the frames of a reference clock.
+    All events are aligned in one batched call. Events after the last
+    reference frame (acquisition ends before stimulus) are set to NaN, as is
+    every event that follows them.
+    Inputs:
+        event_times (array-like)
+            -- Times of the events to align, e.g. stimulus vsync falls.
+        frame_times (array-like)
+            -- Sorted times of the reference frames, e.g. 2P vsync falls.
+        mode (str)
+            -- 'preceding': index of the last frame strictly before each
+               event (-1 for events before the first frame).
+               'nearest': index of the frame closest in time to each event.
+               'fractional': frame position interpolated between frame
+               times (NaN for events before the first frame).
+    Returns:
+        Float array with one frame index per event; all NaN if there are
+        no reference frames.
+    """
+    event_times = np.asarray(event_times, dtype=np.float64).ravel()
+    frame_times = np.asarray(frame_times, dtype=np.float64).ravel()
+    num_frames = len(frame_times)
+
+    if mode not in ('preceding', 'nearest', 'fractional'):
+        raise ValueError('Unknown alignment mode: {}'.format(mode))
+    if num_frames == 0:
+        # no reference frames: every event is after the acquisition
+        if len(event_times) > 0:
             warnings.warn('Acquisition ends before stimulus.', RuntimeWarning)
-            break
+        return np.full(len(event_times), np.nan)
+
+    if mode == 'preceding':
+        frames = np.searchsorted(frame_times, event_times, side='left') - 1
+        frames = frames.astype(np.float64)
+    elif mode == 'nearest':
+        right = np.searchsorted(frame_times, event_times, side='left')
+        right = np.clip(right, 0, num_frames - 1)
+        left = np.clip(right - 1, 0, num_frames - 1)
+        left_is_closer = (
+            event_times - frame_times[left] <= frame_times[right] - event_times
+        )
+        frames = np.where(left_is_closer, left, right).astype(np.float64)
+    elif mode == 'fractional':
+        frames = np.interp(
+            event_times,
+            frame_times,
+            np.arange(num_frames, dtype=np.float64),
+            left=np.nan,
+        )
+    else:
+        raise ValueError('Unknown alignment mode: {}'.format(mode))
 
-    return twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise
+    after_acquisition = np.flatnonzero(event_times > frame_times[-1])
+    if len(after_acquisition) > 0:
+        frames[after_acquisition[0]:] = np.nan
+        warnings.warn('Acquisition ends before stimulus.', RuntimeWarning)
+
+    return frames
 
 def get_2p_vsync_line_label(dataset_obj):
     
     for label in dataset_obj.line_labels:
         if label.find('2p')>-1 and label.find('vsync')>-1:
             return label
-    warnings.warn('2p vsync line not found!', RuntimeWarning)
-    sys.exit()
+    raise KeyError('2p vsync line not found!')
   
 def get_stim_vsync_line_label(dataset_obj):
     
     for label in dataset_obj.line_labels:
         if label.find('stim')>-1 and label.find('vsync')>-1:
             return label      
-    warnings.warn('stim vsync line not found!', RuntimeWarning)
-    sys.exit()
+    raise KeyError('stim vsync line not found!')
 
 def get_photodiode_line_label(dataset_obj):
     
     for label in dataset_obj.line_labels:
         if label.find('photodiode')>-1:
             return label
-    warnings.warn('photodiode line not found!', RuntimeWarning)
-    sys.exit()
+    raise KeyError('photodiode line not found!')
+  
+class Session(object):
+    """Stimulus and sync data of one experiment, loaded on first use.
+    The stim pkl and the sync alignment are each loaded once and cached,
+    and every table is built on first request and memoized.
+    Example:
+        session = Session(exptpath)
+        dg = session.table('drifting_gratings')
+        tables = session.tables(['natural_movie_1', 'spontaneous'])
+    Inputs:
+        exptpath (str)
+            -- Directory containing the _stim.pkl and _sync.h5 files.
+        verbose, cache, sidecar, diagnostics
+            -- Passed to load_stim and load_sync.
+    """
+    
+    def __init__(self, exptpath, verbose=True, sidecar=False, diagnostics=None, cache=False):
+        self.exptpath = exptpath
+        self.verbose = verbose
+        self.cache = cache
+        self.sidecar = sidecar
+        self.diagnostics = diagnostics
+        self._data = None
+        self._sync = None
+        self._tables = {}
+        self._condition_indices = {}
+        self._epoch_index = None
+    
+    @property
+    def data(self):
+        """StimulusData from the stim pkl."""
+        if self._data is None:
+            self._data = load_stim(self.exptpath, verbose=self.verbose, cache=self.cache)
+        return self._data
+    
+    @property
+    def sync(self):
+        """(twop_frames, twop_vsync_fall, stim_vsync_fall, photodiode_rise)
+        as returned by load_sync."""
+        if self._sync is None:
+            self._sync = load_sync(self.exptpath,
+                                   verbose=self.verbose,
+                                   sidecar=self.sidecar,
+                                   diagnostics=self.diagnostics)
+        return self._sync
+    
+    @property
+    def twop_frames(self):
+        return self.sync[0]
+    
+    @property
+    def epoch_index(self):
+        """StimulusEpochIndex of all stimuli of the session."""
+        if self._epoch_index is None:
+            self._epoch_index = StimulusEpochIndex(self.data, self.twop_frames)
+        return self._epoch_index
+    
+    def table(self, name):
+        """Return the stim table called name, building it on first use."""
+        if name not in self._tables:
+            if name == 'spontaneous':
+                self._tables[name] = self.epoch_index.spontaneous_table()
+            else:
+                builder = get_table_builder(name)
+                self._tables[name] = builder(self.data, self.twop_frames)
+        return self._tables[name]
+    
+    def condition_index(self, name):
+        """Return the ConditionIndex of the stim table called name, over all
+        of its columns except Start and End. Built on first use."""
+        if name not in self._condition_indices:
+            self._condition_indices[name] = ConditionIndex.from_table(self.table(name))
+        return self._condition_indices[name]
+    
+    def tables(self, names):
+        """Return a dict of the stim tables called names.
+        Spec-driven tables and clips segments that are not built yet are
+        built together with one walk over the stimuli.
+        """
+        pending = [name for name in names
+                   if name not in self._tables and name in STIM_TABLE_SPECS
+                   and name not in CUSTOM_TABLE_BUILDERS]
+        if len(pending) > 0:
+            self._tables.update(build_stim_tables(self.data, self.twop_frames, pending))
+        pending_clips = [name for name in names
+                         if name not in self._tables and name.startswith('clips_')]
+        if len(pending_clips) > 0:
+            self._tables.update(MovieClips_segment_tables(self.data, self.twop_frames, pending_clips))
+        return {name: self.table(name) for name in names}
+
+def get_session(exptpath):
+    """Return exptpath if it is already a Session, else a new Session."""
+    if isinstance(exptpath, Session):
+        return exptpath
+    return Session(exptpath)
+
+# Tables that need more than a STIM_TABLE_SPECS entry. These take precedence
+# over a spec of the same name.
+CUSTOM_TABLE_BUILDERS = {
+    'center_surround': center_surround_table,
+    'visual_behavior_flashes': visual_behavior_flashes_table,
+    'spontaneous': get_spontaneous_table,
+}
+
+def get_table_builder(name):
+    """Return a function (data, twop_frames) -> stim table for a table name.
+    Raises a KeyError if the name is unknown.
+    """
+    if name in CUSTOM_TABLE_BUILDERS:
+        return CUSTOM_TABLE_BUILDERS[name]
+    if name in STIM_TABLE_SPECS:
+        spec = STIM_TABLE_SPECS[name]
+        return lambda data, twop_frames: build_stim_table(data, twop_frames, spec)
+    if name.startswith('clips_'):
+        get_stim_name_for_segment(name)  # raises KeyError for unknown segments
+        return lambda data, twop_frames: MovieClips_one_segment_table(data, twop_frames, name)
+    raise KeyError('No stim table builder for {}'.format(name))
+  
+# Export of stim table dicts. A saved session is a directory holding one file
+# per table plus metadata.json; tables are stored with compact dtypes (see
+# compact_stim_table). Parquet and Feather need pyarrow, HDF5 needs h5py.
+STIM_TABLE_FORMATS = {'parquet': '.parquet', 'feather': '.feather', 'hdf5': '.h5'}
+CATEGORICAL_COLUMNS = ('stim_name', 'Image')
+stim_tables_version = 1
+
+def compact_stim_table(stim_table):
+    """Return a copy of stim_table with right-sized dtypes.
+    Start/End become nullable Int32, other integer columns int32, float
+    columns (stimulus attributes) float32, and stim_name, Image and string
+    columns categorical.
+    """
+    import pandas as pd
+    
+    stim_table = stim_table.copy()
+    for column in stim_table.columns:
+        values = stim_table[column]
+        if column in ('Start', 'End'):
+            stim_table[column] = values.astype('Int32')
+        elif column in CATEGORICAL_COLUMNS or not pd.api.types.is_numeric_dtype(values):
+            stim_table[column] = values.astype('category')
+        elif pd.api.types.is_bool_dtype(values):
+            continue
+        elif pd.api.types.is_integer_dtype(values):
+            if isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+                stim_table[column] = values.astype('Int32')
+            else:
+                stim_table[column] = values.astype(np.int32)
+        elif pd.api.types.is_float_dtype(values):
+            stim_table[column] = values.astype(np.float32)
+    return stim_table
+
+def save_stim_tables(stim_tables, path, fmt='parquet', metadata=None):
+    """Save a dict of stim tables to the directory path.
+    An existing directory at path is replaced once the new one is written.
+    Inputs:
+        stim_tables (dict)
+            -- Table name -> DataFrame, as returned by the *_tables functions.
+        path (str)
+        fmt (str)
+            -- 'parquet', 'feather' or 'hdf5'.
+        metadata (dict)
+            -- JSON-serializable session information stored with the tables.
+    """
+    import json
+    import shutil
+    
+    if fmt not in STIM_TABLE_FORMATS:
+        raise ValueError('Unknown format {}. Choose from: {}'.format(
+            fmt, ', '.join(sorted(STIM_TABLE_FORMATS))))
+    
+    path = os.path.normpath(path)
+    temp_path = path + '.tmp{}'.format(os.getpid())
+    if os.path.isdir(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    
+    for name, stim_table in stim_tables.items():
+        table_path = os.path.join(temp_path, name + STIM_TABLE_FORMATS[fmt])
+        stim_table = compact_stim_table(stim_table)
+        if fmt == 'hdf5':
+            _write_hdf5_table(stim_table, table_path)
+        else:
+            _write_arrow_table(stim_table, table_path, fmt)
+    
+    with open(os.path.join(temp_path, 'metadata.json'), 'w') as f:
+        json.dump({
+            'version': stim_tables_version,
+            'format': fmt,
+            'tables': list(stim_tables),
+            'session': metadata if metadata is not None else {},
+        }, f, indent=2)
+    
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(temp_path, path)
+
+def load_stim_tables(path, names=None):
+    """Load stim tables saved by save_stim_tables.
+    Parquet and Feather files are memory-mapped while they are read.
+    Inputs:
+        path (str)
+        names (list of str)
+            -- Tables to load; by default all of them.
+    Returns:
+        (dict of table name -> DataFrame, session metadata dict)
+    """
+    import json
+    
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+    fmt = metadata['format']
+    
+    if names is None:
+        names = metadata['tables']
+    stim_tables = {}
+    for name in names:
+        if name not in metadata['tables']:
+            raise KeyError('No stim table {} in {}'.format(name, path))
+        table_path = os.path.join(path, name + STIM_TABLE_FORMATS[fmt])
+        if fmt == 'hdf5':
+            stim_tables[name] = _read_hdf5_table(table_path)
+        else:
+            stim_tables[name] = _read_arrow_table(table_path, fmt)
+    
+    return stim_tables, metadata['session']
+
+def _import_pyarrow(fmt):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('pyarrow is required to save and load {} stim tables'.format(fmt))
+    return pyarrow
+
+def _write_arrow_table(stim_table, table_path, fmt):
+    pa = _import_pyarrow(fmt)
+    table = pa.Table.from_pandas(stim_table)
+    if fmt == 'parquet':
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, table_path)
+    else:
+        # uncompressed, so that reading can map the file without copying
+        import pyarrow.feather
+        pyarrow.feather.write_feather(table, table_path, compression='uncompressed')
+
+def _read_arrow_table(table_path, fmt):
+    _import_pyarrow(fmt)
+    if fmt == 'parquet':
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(table_path, memory_map=True)
+    else:
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(table_path, memory_map=True)
+    stim_table = table.to_pandas()
+    # parquet only keeps string dictionaries; restore numeric categoricals
+    for column in table.schema.pandas_metadata['columns']:
+        name = column['name']
+        if (column['pandas_type'] == 'categorical' and name in stim_table.columns
+                and stim_table[name].dtype.name != 'category'):
+            stim_table[name] = stim_table[name].astype('category')
+    return stim_table
+
+def _write_hdf5_table(stim_table, table_path):
+    """Write each column of stim_table as an HDF5 dataset. Categorical
+    columns are stored as codes and nullable integers with a mask."""
+    import json
+    import h5py
+    import pandas as pd
+    
+    with h5py.File(table_path, 'w') as f:
+        f.attrs['columns'] = json.dumps([str(column) for column in stim_table.columns])
+        f['index'] = stim_table.index.to_numpy()
+        for i_column, column in enumerate(stim_table.columns):
+            values = stim_table[column]
+            name = 'column_{}'.format(i_column)
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                f[name] = values.cat.codes.to_numpy()
+                categories = values.cat.categories
+                if pd.api.types.is_numeric_dtype(categories):
+                    f[name + '_categories'] = categories.to_numpy()
+                else:
+                    f[name].attrs['categories'] = json.dumps(categories.tolist())
+            elif isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+                f[name] = values.to_numpy(dtype=values.dtype.numpy_dtype, na_value=0)
+                f[name + '_mask'] = values.isna().to_numpy()
+            else:
+                f[name] = values.to_numpy()
+            f[name].attrs['dtype'] = str(values.dtype)
+
+def _read_hdf5_table(table_path):
+    import json
+    import h5py
+    import pandas as pd
+    
+    stim_table = {}
+    with h5py.File(table_path, 'r') as f:
+        columns = json.loads(f.attrs['columns'])
+        index = f['index'][()]
+        for i_column, column in enumerate(columns):
+            name = 'column_{}'.format(i_column)
+            values = f[name][()]
+            dtype = f[name].attrs['dtype']
+            if name + '_categories' in f:
+                values = pd.Categorical.from_codes(values, f[name + '_categories'][()])
+            elif 'categories' in f[name].attrs:
+                categories = json.loads(f[name].attrs['categories'])
+                values = pd.Categorical.from_codes(values, categories)
+            elif name + '_mask' in f:
+                values = pd.array(values, dtype=dtype)
+                values[f[name + '_mask'][()]] = pd.NA
+            stim_table[column] = values
+    return pd.DataFrame(stim_table, columns=columns, index=index)
+
+# Trial responses from 2P traces (cells x frames) and stim table Start/End.
+DEFAULT_TRACE_CHUNK_FRAMES = 4096
+
+def open_traces(path, key='data'):
+    """Open a cells x frames trace array without reading it.
+    A .npy file is memory-mapped; for an HDF5 file the h5py dataset key is
+    returned, and is read in chunks by get_trial_windows.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    import h5py
+    return h5py.File(path, 'r')[key]
+
+def get_trial_windows(traces, stim_table, pre_frames=0, post_frames=None, chunk_frames=DEFAULT_TRACE_CHUNK_FRAMES):
+    """Return the trace of every cell around the Start of every trial.
+    Inputs:
+        traces (array-like)
+            -- cells x frames; an ndarray or memmap is read with one
+               gather, other arrays (e.g. h5py datasets) in frame chunks.
+        stim_table (DataFrame)
+            -- Start in 2P frames; rows with a null Start are all NaN.
+        pre_frames (int)
+            -- Frames before Start in the window.
+        post_frames (int)
+            -- Frames from Start on in the window; by default the longest
+               trial (End - Start).
+        chunk_frames (int)
+            -- Frames per read for chunked arrays.
+    Returns:
+        cells x trials x (pre_frames + post_frames) float array. Frames
+        before the first or after the last trace frame are NaN.
+    """
+    starts = stim_table['Start'].to_numpy(dtype=float, na_value=np.nan)
+    if post_frames is None:
+        durations = stim_table['End'].to_numpy(dtype=float, na_value=np.nan) - starts
+        post_frames = int(np.nanmax(durations)) if np.any(np.isfinite(durations)) else 0
+    
+    num_cells, num_frames = traces.shape
+    offsets = np.arange(-pre_frames, post_frames)
+    has_start = np.isfinite(starts)
+    frames = np.where(has_start, starts, 0).astype(np.int64)[:, np.newaxis] + offsets
+    valid = has_start[:, np.newaxis] & (frames >= 0) & (frames < num_frames)
+    
+    dtype = np.result_type(traces.dtype, np.float32)
+    if isinstance(traces, np.ndarray):
+        windows = np.asarray(traces[:, np.clip(frames, 0, max(num_frames - 1, 0))], dtype=dtype)
+    else:
+        windows = np.empty((num_cells,) + frames.shape, dtype=dtype)
+        valid_frames = frames[valid]
+        order = np.argsort(valid_frames, kind='stable')
+        trial_idx, window_idx = np.nonzero(valid)
+        sorted_frames = valid_frames[order]
+        trial_idx = trial_idx[order]
+        window_idx = window_idx[order]
+        if len(sorted_frames) > 0:
+            for chunk_start in range(sorted_frames[0], sorted_frames[-1] + 1, chunk_frames):
+                lo, hi = np.searchsorted(sorted_frames, [chunk_start, chunk_start + chunk_frames])
+                if lo == hi:
+                    continue
+                block = np.asarray(traces[:, chunk_start:chunk_start + chunk_frames])
+                windows[:, trial_idx[lo:hi], window_idx[lo:hi]] = block[:, sorted_frames[lo:hi] - chunk_start]
+    windows[:, ~valid] = np.nan
+    
+    return windows
+
+def get_condition_response_stats(traces, stim_table, columns=None, condition_index=None, pre_frames=0, post_frames=None, chunk_frames=DEFAULT_TRACE_CHUNK_FRAMES):
+    """Return the mean and variance over trials of each cell's response to
+    each condition, reading traces once in frame chunks.
+    The response of a cell to a trial is its mean trace from Start -
+    pre_frames to Start + post_frames (by default to End), clipped to the
+    trace. Only the running sums of trials in progress and the per-condition
+    statistics are kept, and each chunk's finished trials are merged into
+    the statistics of their conditions (Welford/Chan), so memory does not
+    grow with the number of trials.
+    Inputs:
+        traces (array-like)
+            -- cells x frames, e.g. from open_traces.
+        stim_table (DataFrame)
+        columns (list of str)
+            -- Columns defining a condition, as in ConditionIndex.from_table.
+        condition_index (ConditionIndex)
+            -- Index of stim_table to use instead of columns.
+        pre_frames, post_frames (int)
+        chunk_frames (int)
+            -- Frames per read.
+    Returns:
+        dict with
+            'conditions': DataFrame of condition parameters,
+            'mean', 'var': cells x conditions (var with ddof=1, NaN for
+                fewer than 2 trials),
+            'count': trials per condition,
+            'blank_mean', 'blank_var', 'blank_count': the same for blank
+                sweeps.
+    """
+    if condition_index is None:
+        condition_index = ConditionIndex.from_table(stim_table, columns)
+    num_conditions = len(condition_index)
+    # blank sweeps are accumulated as one extra condition
+    trial_conditions = np.where(condition_index.condition_ids >= 0,
+                                condition_index.condition_ids, num_conditions)
+    
+    num_cells, num_frames = traces.shape
+    starts = stim_table['Start'].to_numpy(dtype=float, na_value=np.nan)
+    if post_frames is None:
+        ends = stim_table['End'].to_numpy(dtype=float, na_value=np.nan)
+    else:
+        ends = starts + post_frames
+    starts = starts - pre_frames
+    has_frames = np.isfinite(starts) & np.isfinite(ends)
+    first_frames = np.clip(np.where(has_frames, starts, 0), 0, num_frames).astype(np.int64)
+    last_frames = np.clip(np.where(has_frames, ends, 0), 0, num_frames).astype(np.int64)
+    has_frames &= last_frames > first_frames
+    
+    trials = np.flatnonzero(has_frames)
+    trials = trials[np.argsort(first_frames[trials], kind='stable')]
+    
+    count = np.zeros((num_conditions + 1,), dtype=np.int64)
+    mean = np.zeros((num_cells, num_conditions + 1))
+    M2 = np.zeros((num_cells, num_conditions + 1))
+    
+    active = np.zeros((0,), dtype=np.int64)
+    active_sums = np.zeros((num_cells, 0))
+    next_trial = 0
+    chunk_start = first_frames[trials[0]] if len(trials) > 0 else num_frames
+    last_frame = last_frames[trials].max() if len(trials) > 0 else num_frames
+    while chunk_start < last_frame:
+        chunk_end = min(chunk_start + chunk_frames, last_frame)
+        
+        # trials starting in this chunk become active
+        num_new = np.searchsorted(first_frames[trials[next_trial:]], chunk_end)
+        new_trials = trials[next_trial:next_trial + num_new]
+        next_trial += num_new
+        active = np.concatenate((active, new_trials))
+        active_sums = np.concatenate((active_sums, np.zeros((num_cells, num_new))), axis=1)
+        
+        block = np.asarray(traces[:, chunk_start:chunk_end], dtype=float)
+        cumulative = np.concatenate((np.zeros((num_cells, 1)), np.cumsum(block, axis=1)), axis=1)
+        lo = np.maximum(first_frames[active], chunk_start) - chunk_start
+        hi = np.minimum(last_frames[active], chunk_end) - chunk_start
+        active_sums += cumulative[:, np.maximum(hi, lo)] - cumulative[:, lo]
+        
+        done = last_frames[active] <= chunk_end
+        if np.any(done):
+            responses = active_sums[:, done] / (last_frames[active[done]] - first_frames[active[done]])
+            _merge_condition_stats(count, mean, M2, trial_conditions[active[done]], responses)
+            active = active[~done]
+            active_sums = active_sums[:, ~done]
+        
+        chunk_start = chunk_end
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = np.where(count > 1, M2 / (count - 1), np.nan)
+    mean = np.where(count > 0, mean, np.nan)
+    
+    return {
+        'conditions': condition_index.conditions,
+        'mean': mean[:, :num_conditions],
+        'var': var[:, :num_conditions],
+        'count': count[:num_conditions],
+        'blank_mean': mean[:, num_conditions],
+        'blank_var': var[:, num_conditions],
+        'blank_count': count[num_conditions],
+    }
+
+def _merge_condition_stats(count, mean, M2, conditions, responses):
+    """Merge the responses (cells x trials) of trials of the given
+    conditions into running count, mean and M2 (sum of squared deviations),
+    in place, with Chan et al.'s pairwise update."""
+    order = np.argsort(conditions, kind='stable')
+    conditions = conditions[order]
+    responses = responses[:, order]
+    
+    group_starts = np.flatnonzero(np.concatenate(([True], conditions[1:] != conditions[:-1])))
+    group_conditions = conditions[group_starts]
+    group_count = np.diff(np.append(group_starts, len(conditions)))
+    group_mean = np.add.reduceat(responses, group_starts, axis=1) / group_count
+    deviations = responses - np.repeat(group_mean, group_count, axis=1)
+    group_M2 = np.add.reduceat(deviations**2, group_starts, axis=1)
+    
+    old_count = count[group_conditions]
+    new_count = old_count + group_count
+    delta = group_mean - mean[:, group_conditions]
+    mean[:, group_conditions] += delta * (group_count / new_count)
+    M2[:, group_conditions] += group_M2 + delta**2 * (old_count * group_count / new_count)
+    count[group_conditions] = new_count
+
+PROTOCOLS = {
+    'three_session_A': three_session_A_tables,
+    'three_session_B': three_session_B_tables,
+    'three_session_C': three_session_C_tables,
+    'omFish_gratings': omFish_gratings_tables,
+    'SparseNoise': SparseNoise_tables,
+    'SizeByContrast': SizeByContrast_tables,
+    'coarse_mapping': coarse_mapping_create_stim_tables,
+    'lsnCS': lsnCS_create_stim_tables,
+    'MovieClips': MovieClips_tables,
+}
+
+INPUT_SUFFIXES = ('_stim.pkl', '_sync.h5')
+
+def get_batch_output_path(exptpath, protocol, output_dir, fmt='pickle'):
+    """Return the output file (pickle) or directory (see save_stim_tables)
+    for one session of a batch run. The name holds a short hash of the
+    absolute exptpath, so sessions with the same folder name under
+    different parents do not overwrite each other."""
+    import hashlib
+    
+    exptpath = os.path.abspath(exptpath)
+    session_name = os.path.basename(os.path.normpath(exptpath))
+    path_hash = hashlib.sha1(exptpath.encode('utf-8')).hexdigest()[:8]
+    # columnar formats write a directory, so it gets no file extension
+    extension = '.pkl' if fmt == 'pickle' else '_' + fmt
+    return os.path.join(output_dir, session_name + '_' + path_hash + '_' + protocol + '_stim_tables' + extension)
+
+def is_output_up_to_date(exptpath, outpath):
+    """True if outpath exists and is newer than the session's input files."""
+    if os.path.isdir(outpath):
+        outpath = os.path.join(outpath, 'metadata.json')
+    if not os.path.isfile(outpath):
+        return False
+    output_mtime = os.path.getmtime(outpath)
+    for f in os.listdir(exptpath):
+        if f.endswith(INPUT_SUFFIXES):
+            if os.path.getmtime(os.path.join(exptpath, f)) > output_mtime:
+                return False
+    return True
+
+def run_batch_session(protocol, exptpath, outpath, sidecar=False, cache=False, fmt='pickle'):
+    """Build and save the stim tables of one session.
+    Errors are caught and returned so that one bad session does not stop a
+    batch.
+    Returns:
+        (exptpath, error message or None, seconds elapsed)
+    """
+    import traceback
+    import time
+    import pandas as pd
+    
+    start_time = time.time()
+    try:
+        session = Session(exptpath, verbose=False, sidecar=sidecar, cache=cache)
+        stim_table = PROTOCOLS[protocol](session)
+        if fmt == 'pickle':
+            temp_path = outpath + '.tmp{}'.format(os.getpid())
+            try:
+                pd.to_pickle(stim_table, temp_path)
+                os.replace(temp_path, outpath)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        else:
+            save_stim_tables(stim_table, outpath, fmt,
+                             metadata={'exptpath': os.path.abspath(exptpath),
+                                       'protocol': protocol})
+        error = None
+    except (Exception, SystemExit):
+        # SystemExit too, so that a session calling sys.exit() fails alone
+        error = traceback.format_exc()
+    return exptpath, error, time.time() - start_time
+
+def run_batch(protocol, exptpaths, output_dir, jobs=1, force=False, sidecar=False, cache=False, fmt='pickle'):
+    """Build stim tables for many sessions over a process pool.
+    Sessions whose output is newer than their inputs are skipped unless
+    force is set. A summary of the run is printed.
+    Returns:
+        dict of exptpath -> 'done', 'skipped' or the error message.
+    """
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+    
+    if protocol not in PROTOCOLS:
+        raise KeyError('Unknown protocol {}. Choose from: {}'.format(
+            protocol, ', '.join(sorted(PROTOCOLS))))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    
+    results = {}
+    todo = []
+    for exptpath in exptpaths:
+        outpath = get_batch_output_path(exptpath, protocol, output_dir, fmt)
+        if not force and is_output_up_to_date(exptpath, outpath):
+            results[exptpath] = 'skipped'
+        else:
+            todo.append((exptpath, outpath))
+    
+    start_time = time.time()
+    if jobs == 1:
+        finished = (run_batch_session(protocol, e, o, sidecar, cache, fmt) for e, o in todo)
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        futures = [executor.submit(run_batch_session, protocol, e, o, sidecar, cache, fmt) for e, o in todo]
+        finished = _collect_batch_results(todo, futures)
+    
+    for exptpath, error, elapsed in finished:
+        if error is None:
+            results[exptpath] = 'done'
+            print('done    {} ({:.1f} s)'.format(exptpath, elapsed))
+        else:
+            results[exptpath] = error
+            print('FAILED  {} ({:.1f} s)'.format(exptpath, elapsed))
+            print(error)
+    if jobs != 1:
+        executor.shutdown()
+    elapsed = time.time() - start_time
+    
+    statuses = list(results.values())
+    num_done = statuses.count('done')
+    num_skipped = statuses.count('skipped')
+    num_failed = len(statuses) - num_done - num_skipped
+    print('*' * 70)
+    print('Protocol: {}  Sessions: {}'.format(protocol, len(statuses)))
+    print('Done: {}  Skipped (up to date): {}  Failed: {}'.format(num_done, num_skipped, num_failed))
+    if num_done > 0:
+        print('Elapsed: {:.1f} s  Throughput: {:.2f} sessions/s'.format(elapsed, num_done / elapsed))
+    for exptpath, status in results.items():
+        if status not in ('done', 'skipped'):
+            print('Failed: ' + exptpath)
+    print('*' * 70)
+    
+    return results
+
+def _collect_batch_results(todo, futures):
+    """Yield worker results, turning a crashed worker into a session error."""
+    import traceback
+    
+    for (exptpath, outpath), future in zip(todo, futures):
+        try:
+            yield future.result()
+        except (Exception, SystemExit):
+            yield exptpath, traceback.format_exc(), 0.0
+
+def expand_exptpaths(patterns):
+    """Expand directories and glob patterns into experiment directories."""
+    import glob
+    
+    exptpaths = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(path) and path not in exptpaths:
+                exptpaths.append(path)
+    return exptpaths
+
+def main(argv=None):
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog='python -m stim_table')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    batch = subparsers.add_parser('batch', help='build stim tables for many experiment directories')
+    batch.add_argument('protocol', choices=sorted(PROTOCOLS))
+    batch.add_argument('exptpaths', nargs='+', help='experiment directories or glob patterns')
+    batch.add_argument('-o', '--output-dir', required=True)
+    batch.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    batch.add_argument('--force', action='store_true', help='rebuild sessions whose outputs are up to date')
+    batch.add_argument('--sidecar', action='store_true', help='reuse/write sync edge sidecar files')
+    batch.add_argument('--stim-cache', action='store_true', help='reuse/write columnar stim pkl caches')
+    batch.add_argument('--format', default='pickle', choices=['pickle'] + sorted(STIM_TABLE_FORMATS),
+                       help='output format; columnar formats write one directory per session')
+    
+    args = parser.parse_args(argv)
+    if args.command != 'batch':
+        parser.print_help()
+        return 1
+    
+    exptpaths = expand_exptpaths(args.exptpaths)
+    if not exptpaths:
+        print('No experiment directories found.')
+        return 1
+    
+    results = run_batch(args.protocol, exptpaths, args.output_dir,
+                        jobs=args.jobs, force=args.force, sidecar=args.sidecar,
+                        cache=args.stim_cache, fmt=args.format)
+    failed = [status for status in results.values() if status not in ('done', 'skipped')]
+    return 1 if failed else 0
   
-if __name__=='__main__':  
-    
-    #exptpath = '/Users/danielm/Desktop/py_code/StimTable/sample_sessions/session_A/'
-    #three_session_A_tables(exptpath)
-    
-    #exptpath = '/Users/danielm/Desktop/py_code/StimTable/sample_sessions/session_B/'
-    #three_session_B_tables(exptpath)
-    
-    #exptpath = '/Users/danielm/Desktop/py_code/StimTable/sample_sessions/session_C/'
-    #three_session_C_tables(exptpath)
-    
-     #exptpath = '/Users/danielm/Desktop/py_code/StimTable/sample_sessions/MovieClips/'
-     #MovieClips_tables(exptpath,verbose=True)
-    
-     #exptpath = '/Users/danielm/Desktop/stim_sessions/SizeByContrast_day1to9/'
-     #SizeByContrast_tables(exptpath)
-     
-     # exptpath = '/Users/danielm/Desktop/stim_sessions/Deepscope_test_3/'
-     # omFish_gratings_tables(exptpath,verbose=True)
-     
-     # exptpath = '/Users/danielm/Desktop/stim_sessions/Deepscope_day1_1143565396/'
-     # st = SizeByContrast_tables(exptpath)
-     
-     exptpath = '/Volumes/Extreme Pro/visual_behavior/'
-     session_ID = 792619807
-     st = VisualBehavior_NM1_table(exptpath,session_ID)
-     print(st)
-     
-     #exptpath = '/Users/danielm/Desktop/stim_sessions/Deepscope_day0_test_2/'
-     #SparseNoise_tables(exptpath)
\ No newline at end of file
+if __name__=='__main__':
+    sys.exit(main())
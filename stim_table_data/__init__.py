@@ -0,0 +1 @@
+"""Package data of stim_table: clip info of the MovieClips stimuli."""
@@ -5,15 +5,45 @@ Dataset object for loading and unpacking a sync dataset.
 
 """
 from __future__ import unicode_literals
+from collections import OrderedDict
 import datetime
+import hashlib
+import json
+import os
 import pprint
+import warnings
 
-import h5py as h5
 import numpy as np
 
 
 dset_version = 1.0
 
+# default memory budget for arrays derived from the event data (bytes)
+DEFAULT_CACHE_BYTES = 512 * 1024 ** 2
+
+# default number of events read per chunk when streaming
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+sidecar_version = 1
+
+
+def get_sidecar_path(path):
+    """
+    Returns the path of the edge index sidecar for a sync file.
+    """
+    return os.path.splitext(path)[0] + '_edges.npz'
+
+
+def hash_file(path, block_size=2 ** 20):
+    """
+    Returns the sha1 hex digest of a file's contents.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
 
 def unpack_uint32(uint32_array, endian='L'):
     """
@@ -40,35 +70,210 @@ def get_bit(uint_array, bit):
     return np.bitwise_and(uint_array, 2 ** bit).astype(bool).astype(np.uint8)
 
 
+def unwrap_counter(lsb, msb=None, previous=None):
+    """
+    Reconstructs monotonic 64-bit counter values from 32-bit counter
+        samples in O(N).
+
+    A rollover is counted wherever the LSB counter decreases, and each
+        sample is offset by its cumulative rollover count.  For 64-bit
+        recordings the MSB column is used as well: if it holds the full upper
+        word it is combined with the LSB directly; if it only toggles on each
+        rollover, its parity adds the rollovers that happened between two
+        events without the LSB decreasing.
+
+    When a recording is unwrapped in blocks, `previous` is the
+        (lsb, msb, counter value) of the sample preceding the block.
+
+    """
+    lsb = np.asarray(lsb).astype(np.int64)
+    if msb is not None:
+        msb = np.asarray(msb).astype(np.int64)
+        if len(msb) and msb.max() > 1:
+            return lsb + (msb << 32)
+
+    if previous is not None:
+        lsb = np.concatenate(([previous[0]], lsb))
+        if msb is not None:
+            msb = np.concatenate(([previous[1]], msb))
+
+    rollovers = np.zeros(len(lsb), dtype=np.int64)
+    rollovers[1:] = lsb[1:] < lsb[:-1]
+    if msb is not None:
+        parity_changed = np.bitwise_and(np.bitwise_xor(msb[1:], msb[:-1]), 1)
+        rollovers[1:] += np.bitwise_and(rollovers[1:], 1) != parity_changed
+    np.cumsum(rollovers, out=rollovers)
+    times = lsb + (rollovers << 32)
+
+    if previous is not None:
+        times = times[1:] + (previous[2] - previous[0])
+    return times
+
+
 class Dataset(object):
     """
     A sync dataset.  Contains methods for loading
         and parsing the binary data.
 
+    The event array is read from disk on first use and kept until
+        `release` or `close` is called.  Arrays derived from it (times,
+        bit words, transitions) are kept in a least-recently-used cache
+        bounded by `cache_bytes`.
+
+    With `sidecar` enabled, the rollover-corrected rising and falling
+        edges of every line are written once to `<name>_edges.npz` next to
+        the sync file, and later opens read edges from there instead of
+        parsing the event data.  The sidecar is keyed by the sync file's
+        size, mtime and sha1, and is rebuilt if they no longer match.
+
+    Parameters
+    ----------
+    path : str
+        Path to the hdf5 sync file.
+    cache_bytes : int (DEFAULT_CACHE_BYTES)
+        Memory budget for cached derived arrays.  0 disables the cache.
+    sidecar : bool (False)
+        Read and write the per-line edge index sidecar.
+
     """
 
-    def __init__(self, path):
+    def __init__(self, path, cache_bytes=DEFAULT_CACHE_BYTES, sidecar=False):
+        self.path = path
+        self.cache_bytes = cache_bytes
+        self.sidecar = sidecar
+        self._events = None
+        self._cache = OrderedDict()
+        self._sidecar_edges = None
         self.load(path)
 
-        self.times = self._process_times()
+    @property
+    def times(self):
+        """
+        Rollover-corrected counter values.
+        """
+        return self._cached('times', self._process_times)
 
-    def _process_times(self):
-        times = self.get_all_events()[:, 0:1].astype(np.int64)
+    def _cached(self, key, compute):
+        """
+        Returns a derived array from the cache, computing and storing it if
+            it is missing.  Least recently used entries are evicted to stay
+            within `cache_bytes`.
+        """
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
 
-        intervals = np.ediff1d(times, to_begin=0)
-        rollovers = np.where(intervals < 0)[0]
+        value = compute()
+        if value.nbytes <= self.cache_bytes:
+            self._cache[key] = value
+            cached_bytes = sum(v.nbytes for v in self._cache.values())
+            while cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                cached_bytes -= evicted.nbytes
+        return value
 
-        for i in rollovers:
-            times[i:] += 4294967296
+    def release(self):
+        """
+        Frees the event array and all cached derived arrays.  They are
+            reloaded from the file on next use.
+        """
+        self._events = None
+        self._cache.clear()
+        self._sidecar_edges = None
 
-        return times
+    def _sidecar_key(self):
+        """
+        Returns the size and mtime of the sync file.
+        """
+        stat = os.stat(self.path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def _read_sidecar(self):
+        """
+        Returns {bit: (rising, falling)} from the sidecar, or None if it is
+            missing or out of date.  A sidecar whose mtime no longer matches
+            is still used, and its key refreshed, if the file contents hash
+            the same.
+        """
+        sidecar_path = get_sidecar_path(self.path)
+        if not os.path.isfile(sidecar_path):
+            return None
+
+        with np.load(sidecar_path) as sidecar:
+            stored_key = json.loads(str(sidecar['key']))
+            if stored_key.get('version') != sidecar_version:
+                return None
+            key = self._sidecar_key()
+            if key['size'] != stored_key['size']:
+                return None
+            touched = key['mtime_ns'] != stored_key['mtime_ns']
+            if touched and hash_file(self.path) != stored_key['sha1']:
+                return None
+            edges = {}
+            for bit in range(32):
+                edges[bit] = (
+                    sidecar['rising_%i' % bit],
+                    sidecar['falling_%i' % bit],
+                )
+
+        if touched:
+            self._write_sidecar(edges, sha1=stored_key['sha1'])
+        return edges
+
+    def _write_sidecar(self, edges, sha1=None):
+        """
+        Writes {bit: (rising, falling)} to the sidecar. Warns instead of
+            raising if it cannot be written, e.g. in a read-only directory.
+        """
+        key = self._sidecar_key()
+        key['sha1'] = sha1 if sha1 is not None else hash_file(self.path)
+        key['version'] = sidecar_version
+
+        arrays = {'key': np.array(json.dumps(key))}
+        for bit, (rising, falling) in edges.items():
+            arrays['rising_%i' % bit] = rising
+            arrays['falling_%i' % bit] = falling
+
+        sidecar_path = get_sidecar_path(self.path)
+        temp_path = sidecar_path + '.tmp%i' % os.getpid()
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temp_path, sidecar_path)
+        except OSError as e:
+            # the sidecar is only a cache; edges are still returned
+            warnings.warn('Could not write sync sidecar %s: %s'
+                          % (sidecar_path, e), RuntimeWarning)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _get_sidecar_edges(self, chunk_size=None):
+        """
+        Returns {bit: (rising, falling)} for all bits from the sidecar,
+            creating or refreshing it if needed.
+        """
+        if self._sidecar_edges is None:
+            edges = self._read_sidecar()
+            if edges is None:
+                edges = self._compute_edges(list(range(32)), chunk_size)
+                self._write_sidecar(edges)
+            self._sidecar_edges = edges
+        return self._sidecar_edges
+
+    def _process_times(self):
+        events = self.get_all_events()
+        if self.meta_data['ni_daq']['counter_bits'] == 64:
+            return unwrap_counter(events[:, 0], events[:, 1])
+        return unwrap_counter(events[:, 0])
 
     def load(self, path):
         """
         Loads an hdf5 sync dataset.
         """
+        import h5py as h5
+
         self.dfile = h5.File(path, 'r')
-        self.meta_data = eval(self.dfile['meta'].value)
+        self.meta_data = eval(self.dfile['meta'][()])
         self.line_labels = self.meta_data['line_labels']
         return self.dfile
 
@@ -97,31 +302,23 @@ class Dataset(object):
         """
         Returns the data for all bits.
         """
-        return self.dfile['data'].value[:, -1]
+        return self._cached(
+            'bits', lambda: np.ascontiguousarray(self.get_all_events()[:, -1])
+        )
 
     def get_all_times(self):
         """
-        Returns all counter values.
+        Returns all counter values, corrected for counter rollovers.
         """
-        if self.meta_data['ni_daq']['counter_bits'] == 32:
-            return self.get_all_events()[:, 0]
-        else:
-            """
-
-            #this doesn't work because actually the rollover isn't a pulse
-            #it goes high after the first rollover then low after the second
-
-            times = self.get_all_events()[:, 0:2].astype(np.uint64)
-            times = times[:, 0] + times[:, 1]*np.uint64(4294967296)
-            return times
-            """
-            return self.times
+        return self.times
 
     def get_all_events(self):
         """
         Returns all counter values and their cooresponding IO state.
         """
-        return self.dfile['data'].value
+        if self._events is None:
+            self._events = self.dfile['data'][()]
+        return self._events
 
     def get_events_by_bit(self, bit):
         """
@@ -151,26 +348,155 @@ class Dataset(object):
         else:
             raise TypeError("Incorrect line type.  Try a str or int.")
 
+    def get_all_edges(self, lines=None, chunk_size=None):
+        """
+        Returns the counter values for the rising and falling edges of
+            several lines from a single pass over the event words.
+
+        Consecutive event words are XORed once; each line's edges are then
+            picked out of the changed bits.  Lines that never change are
+            skipped without scanning.
+
+        Parameters
+        ----------
+        lines : list (None)
+            Line names and/or bits.  Defaults to all 32 bits.
+        chunk_size : int (None)
+            If given, stream the file in chunks of this many events (see
+            `iter_edges`) instead of loading the full event data.
+
+        Returns
+        -------
+        dict
+            {line: (rising, falling)} for each requested line.
+
+        """
+        if lines is None:
+            lines = list(range(32))
+
+        if self.sidecar:
+            edges = self._get_sidecar_edges(chunk_size)
+            return {line: edges[self._line_to_bit(line)] for line in lines}
+
+        return self._compute_edges(lines, chunk_size)
+
+    def _compute_edges(self, lines, chunk_size=None):
+        """
+        Extracts the edges of several lines from the event data.
+        """
+        if chunk_size is not None:
+            chunks = list(self.iter_edges(lines, chunk_size))
+            edges = {}
+            for line in lines:
+                edges[line] = tuple(
+                    np.concatenate([c[line][i] for c in chunks])
+                    for i in (0, 1)
+                )
+            return edges
+
+        words = self.get_all_bits()
+        times = self.get_all_times()
+
+        changed = self._cached(
+            'changed', lambda: np.bitwise_xor(words[1:], words[:-1])
+        )
+        rising_words = self._cached(
+            'rising_words', lambda: np.bitwise_and(changed, words[1:])
+        )
+        # the first event has no predecessor, so edges start at event 1
+        return self._split_edges(changed, rising_words, times[1:], lines)
+
+    def iter_edges(self, lines=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Yields the rising and falling edges of several lines chunk by chunk,
+            reading the file `chunk_size` events at a time.
+
+        The last event word and counter state are carried across chunk
+            boundaries, so concatenating the chunks gives the same result
+            as `get_all_edges`.  Memory use is bounded by the chunk size and
+            nothing is added to the cache.
+
+        Yields
+        ------
+        dict
+            {line: (rising, falling)} for the events in each chunk.
+
+        """
+        if lines is None:
+            lines = list(range(32))
+
+        data = self.dfile['data']
+        counter_64 = self.meta_data['ni_daq']['counter_bits'] == 64
+        previous = None
+
+        for start in range(0, len(data), chunk_size):
+            events = data[start:start + chunk_size]
+            lsb = events[:, 0]
+            msb = events[:, 1] if counter_64 else None
+            words = events[:, -1]
+
+            if previous is None:
+                times = unwrap_counter(lsb, msb)
+                changed = np.bitwise_xor(words[1:], words[:-1])
+                rising_words = np.bitwise_and(changed, words[1:])
+                edge_times = times[1:]
+            else:
+                times = unwrap_counter(lsb, msb, previous[:3])
+                last_words = np.concatenate(([previous[3]], words[:-1]))
+                changed = np.bitwise_xor(words, last_words)
+                rising_words = np.bitwise_and(changed, words)
+                edge_times = times
+
+            yield self._split_edges(changed, rising_words, edge_times, lines)
+
+            previous = (
+                lsb[-1],
+                msb[-1] if counter_64 else 0,
+                times[-1],
+                words[-1],
+            )
+
+    def _split_edges(self, changed, rising_words, times, lines):
+        """
+        Picks the rising and falling edges of each line out of the changed
+            bits of consecutive event words.  `times` holds the counter
+            value of the later event of each pair.
+        """
+        active = int(np.bitwise_or.reduce(changed)) if len(changed) else 0
+
+        edges = {}
+        for line in lines:
+            bit = self._line_to_bit(line)
+            mask = 1 << bit
+            if not active & mask:
+                edges[line] = (times[:0], times[:0])
+                continue
+            line_changed = np.bitwise_and(changed, mask).astype(bool)
+            line_rising = np.bitwise_and(rising_words, mask).astype(bool)
+            rising = np.flatnonzero(line_rising)
+            falling = np.flatnonzero(line_changed & ~line_rising)
+            edges[line] = (times[rising], times[falling])
+        return edges
+
     def get_rising_edges(self, line):
         """
         Returns the counter values for the rizing edges for a specific bit.
         """
-        bit = self._line_to_bit(line)
-        changes = self.get_bit_changes(bit)
-        return self.get_all_times()[np.where(changes == 1)]
+        return self.get_all_edges([line])[line][0]
 
     def get_falling_edges(self, line):
         """
         Returns the counter values for the falling edges for a specific bit.
         """
-        bit = self._line_to_bit(line)
-        changes = self.get_bit_changes(bit)
-        return self.get_all_times()[np.where(changes == 255)]
+        return self.get_all_edges([line])[line][1]
 
-    def line_stats(self, line, print_results=True):
+    def line_stats(self, line, print_results=True, edges=None):
         """
         Quick-and-dirty analysis of a bit.
 
+        `edges` is an optional (rising, falling) pair from `get_all_edges`,
+            so that callers analysing many lines only scan the data once.
+
         ##TODO: Split this up into smaller functions.
 
         """
@@ -178,21 +504,18 @@ class Dataset(object):
         bit = self._line_to_bit(line)
 
         # get the bit's data
-        bit_data = self.get_bit(bit)
-        total_data_points = len(bit_data)
-
-        # get the events
-        events = self.get_events_by_bit(bit)
-        total_events = len(events)
+        total_data_points = len(self.get_all_bits())
 
-        # get the rising edges
-        rising = self.get_rising_edges(bit)
+        # get the rising and falling edges
+        if edges is None:
+            edges = self.get_all_edges([bit])[bit]
+        rising, falling = edges
         total_rising = len(rising)
-
-        # get falling edges
-        falling = self.get_falling_edges(bit)
         total_falling = len(falling)
 
+        # get the events
+        total_events = total_rising + total_falling
+
         if total_events <= 0:
             if print_results:
                 print(("*" * 70))
@@ -217,7 +540,7 @@ class Dataset(object):
         else:
 
             # period
-            period = self.period(line)
+            period = self.period(line, edges=rising)
 
             avg_period = period['avg']
             max_period = period['max']
@@ -225,7 +548,7 @@ class Dataset(object):
             period_sd = period['sd']
 
             # freq
-            avg_freq = self.frequency(line)
+            avg_freq = 1.0 / avg_period
 
             # duty cycle
             duty_cycle = self.duty_cycle(line)
@@ -263,16 +586,19 @@ class Dataset(object):
                 'duty_cycle': duty_cycle,
             }
 
-    def period(self, line, edge="rising"):
+    def period(self, line, edge="rising", edges=None):
         """
         Returns a dictionary with avg, min, max, and sd of period for a line.
+
+        `edges` optionally supplies precomputed edge counter values.
         """
         bit = self._line_to_bit(line)
 
-        if edge.lower() == "rising":
-            edges = self.get_rising_edges(bit)
-        elif edge.lower() == "falling":
-            edges = self.get_falling_edges(bit)
+        if edges is None:
+            if edge.lower() == "rising":
+                edges = self.get_rising_edges(bit)
+            elif edge.lower() == "falling":
+                edges = self.get_falling_edges(bit)
 
         if len(edges) > 1:
 
@@ -343,9 +669,12 @@ class Dataset(object):
         Quick-and-dirty analysis of all bits.  Prints a few things about each
             bit where events are found.
         """
+        edges = self.get_all_edges(list(range(32)))
         bits = []
         for i in range(32):
-            bits.append(self.line_stats(i, print_results=False))
+            bits.append(
+                self.line_stats(i, print_results=False, edges=edges[i])
+            )
         active_bits = [x for x in bits if x is not None]
         print(("Active bits: ", len(active_bits)))
         for bit in active_bits:
@@ -389,6 +718,7 @@ class Dataset(object):
         """
         Closes the dataset.
         """
+        self.release()
         self.dfile.close()
 
 